@@ -0,0 +1,192 @@
+import argparse
+import gzip
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+
+## Lists the files of an output directory and the blobs holding their content
+MANIFEST_NAME = "artifacts.json"
+
+
+def file_digest(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class ArtifactStore:
+    """
+    Content addressed store of the artifacts of the trials, one read-only blob per distinct file content
+    An output directory holds a manifest and hardlinks to the blobs, so the role files, playbooks
+    and snapshots that are the same across findings are stored only once.
+    Cold output directories can be packed down to their manifest, their blobs are then gzipped
+    as soon as no other output directory links to them.
+    """
+
+    def __init__(self, root: str) -> None:
+        self.root = root
+        os.makedirs(self.root, exist_ok=True)
+
+    def blob_path(self, digest: str) -> str:
+        return os.path.join(self.root, digest[:2], digest[2:])
+
+    def put(self, path: str) -> str:
+        """Add the content of a file to the store, returns its digest"""
+        digest = file_digest(path)
+        blob = self.blob_path(digest)
+        if not os.path.exists(blob) and not os.path.exists(f"{blob}.gz"):
+            os.makedirs(os.path.dirname(blob), exist_ok=True)
+            # Copy next to the blob first, so a blob is never seen half written
+            staging = f"{blob}.{os.getpid()}.{threading.get_ident()}.tmp"
+            shutil.copyfile(path, staging)
+            os.chmod(staging, 0o444)
+            os.replace(staging, blob)
+        return digest
+
+    def materialize(self, digest: str, destination: str) -> None:
+        """Link a blob at destination, decompressing it first if it was packed"""
+        blob = self.blob_path(digest)
+        if not os.path.exists(blob):
+            staging = f"{blob}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with gzip.open(f"{blob}.gz", "rb") as packed, open(staging, "wb") as f:
+                shutil.copyfileobj(packed, f)
+            os.chmod(staging, 0o444)
+            os.replace(staging, blob)
+            os.remove(f"{blob}.gz")
+        os.makedirs(os.path.dirname(destination), exist_ok=True)
+        try:
+            os.link(blob, destination)
+        except OSError:
+            shutil.copyfile(blob, destination)
+
+    def store(self, destination: str, sources: list) -> dict:
+        """
+        Store the files of each (source directory, relative path) of sources under destination
+        Symlinks are followed, like shutil.copytree does. Returns the updated manifest.
+        """
+        manifest = read_manifest(destination)
+        for source, relative_path in sources:
+            for currentpath, folders, files in os.walk(source, followlinks=True):
+                folders.sort()
+                for filename in sorted(files):
+                    filepath = os.path.join(currentpath, filename)
+                    if not os.path.isfile(filepath):
+                        # Dangling symlinks, sockets...
+                        continue
+                    name = os.path.normpath(
+                        os.path.join(relative_path, os.path.relpath(filepath, source))
+                    )
+                    digest = self.put(filepath)
+                    target = os.path.join(destination, name)
+                    if os.path.lexists(target):
+                        os.remove(target)
+                    self.materialize(digest, target)
+                    manifest["files"][name] = digest
+        write_manifest(destination, manifest)
+        return manifest
+
+    def pack(self, output_path: str) -> None:
+        """Drop the files of an output directory, its manifest is enough to restore them"""
+        manifest = read_manifest(output_path)
+        if manifest["packed"]:
+            return
+        for name in os.listdir(output_path):
+            if name != MANIFEST_NAME:
+                path = os.path.join(output_path, name)
+                if os.path.isdir(path) and not os.path.islink(path):
+                    shutil.rmtree(path)
+                else:
+                    os.remove(path)
+        manifest["packed"] = True
+        write_manifest(output_path, manifest)
+
+    def unpack(self, output_path: str) -> None:
+        manifest = read_manifest(output_path)
+        for name, digest in manifest["files"].items():
+            target = os.path.join(output_path, name)
+            if not os.path.lexists(target):
+                self.materialize(digest, target)
+        manifest["packed"] = False
+        write_manifest(output_path, manifest)
+
+    def compress_unlinked(self) -> int:
+        """Gzip the blobs no output directory links to anymore, returns the number of bytes saved"""
+        saved = 0
+        for currentpath, _, files in os.walk(self.root):
+            for filename in files:
+                blob = os.path.join(currentpath, filename)
+                if filename.endswith((".gz", ".tmp")) or os.stat(blob).st_nlink > 1:
+                    continue
+                with open(blob, "rb") as f, gzip.open(f"{blob}.gz.tmp", "wb") as packed:
+                    shutil.copyfileobj(f, packed)
+                os.replace(f"{blob}.gz.tmp", f"{blob}.gz")
+                saved += os.path.getsize(blob) - os.path.getsize(f"{blob}.gz")
+                os.remove(blob)
+        return saved
+
+
+def read_manifest(output_path: str) -> dict:
+    path = os.path.join(output_path, MANIFEST_NAME)
+    if not os.path.exists(path):
+        return {"files": {}, "packed": False}
+    with open(path) as f:
+        return json.load(f)
+
+
+def write_manifest(output_path: str, manifest: dict) -> None:
+    os.makedirs(output_path, exist_ok=True)
+    with open(os.path.join(output_path, MANIFEST_NAME), "w") as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+
+
+def find_outputs(root: str, objects: str):
+    """The output directories stored in the artifact store"""
+    for currentpath, folders, files in os.walk(root):
+        if os.path.abspath(currentpath) == os.path.abspath(objects):
+            folders.clear()
+            continue
+        if MANIFEST_NAME in files:
+            folders.clear()
+            yield currentpath
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Pack and unpack the stored artifacts of the trials"
+    )
+    parser.add_argument("command", choices=["pack", "unpack"])
+    parser.add_argument(
+        "paths", nargs="*", help="Output directories, all of the cold ones by default"
+    )
+    parser.add_argument("--output", default="output")
+    parser.add_argument(
+        "--older-than",
+        type=float,
+        default=24,
+        help="Hours since an output directory was written for it to count as cold",
+    )
+    args = parser.parse_args()
+
+    store = ArtifactStore(os.path.join(args.output, "objects"))
+    paths = args.paths
+    if args.command == "pack":
+        if len(paths) == 0:
+            cutoff = time.time() - args.older_than * 3600
+            paths = [
+                path
+                for path in find_outputs(args.output, store.root)
+                if os.path.getmtime(os.path.join(path, MANIFEST_NAME)) < cutoff
+            ]
+        for path in paths:
+            store.pack(path)
+        saved = store.compress_unlinked()
+        print(f"Packed {len(paths)} output directories, saved {saved / 2**20:.1f} MiB")
+    else:
+        for path in paths:
+            store.unpack(path)
+        print(f"Unpacked {len(paths)} output directories")
@@ -0,0 +1,91 @@
+import hashlib
+import json
+import os
+import shutil
+
+import docker
+
+from checkpoints import Checkpoint, remove_images
+
+
+class BaselineCache:
+    """
+    Content addressed store of baseline runs.
+    A baseline only depends on what is mounted into the host (the role with its snapshot tasks,
+    env_setup.sh, collect_state.py and the playbook) and on the images, so it is keyed on those.
+    """
+
+    def __init__(self, root: str) -> None:
+        self.root = root
+        os.makedirs(self.root, exist_ok=True)
+
+    def key(self, host_mnt: str, image_ids: list, extra: dict) -> str:
+        digest = hashlib.sha256()
+        for image_id in image_ids:
+            digest.update(image_id.encode())
+        digest.update(json.dumps(extra, sort_keys=True).encode())
+        for currentpath, folders, files in os.walk(host_mnt):
+            folders.sort()
+            for filename in sorted(files):
+                filepath = os.path.join(currentpath, filename)
+                digest.update(os.path.relpath(filepath, host_mnt).encode() + b"\0")
+                with open(filepath, "rb") as f:
+                    for chunk in iter(lambda: f.read(1 << 20), b""):
+                        digest.update(chunk)
+                digest.update(b"\0")
+        return digest.hexdigest()
+
+    def load(self, key: str, output_path: str, client, need_checkpoints=False):
+        """
+        Restore a cached baseline to output_path
+        Returns its checkpoints, or None if there is no usable entry
+        """
+        entry = os.path.join(self.root, key)
+        if not os.path.exists(os.path.join(entry, "checkpoints.json")):
+            return None
+        with open(os.path.join(entry, "checkpoints.json")) as f:
+            checkpoints = [Checkpoint(c["state_id"], c["image"]) for c in json.load(f)]
+        if need_checkpoints:
+            if len(checkpoints) == 0:
+                return None
+            for checkpoint in checkpoints:
+                try:
+                    client.images.get(checkpoint.image)
+                except docker.errors.ImageNotFound:
+                    return None
+        if os.path.exists(output_path):
+            shutil.rmtree(output_path)
+        shutil.copytree(os.path.join(entry, "baseline"), output_path)
+        return checkpoints
+
+    def images(self) -> set:
+        """The checkpoint images the cached baselines refer to"""
+        images = set()
+        for key in os.listdir(self.root):
+            path = os.path.join(self.root, key, "checkpoints.json")
+            if os.path.exists(path):
+                with open(path) as f:
+                    images.update(c["image"] for c in json.load(f))
+        return images
+
+    def store(self, key: str, output_path: str, checkpoints: list, client) -> None:
+        """Store a baseline, the checkpoint images of the entry it replaces are removed if it does not reuse them"""
+        entry = os.path.join(self.root, key)
+        # Build the entry next to its final location, so a crash never leaves half an entry
+        staging = f"{entry}.{os.getpid()}.tmp"
+        if os.path.exists(staging):
+            shutil.rmtree(staging)
+        shutil.copytree(output_path, os.path.join(staging, "baseline"))
+        with open(os.path.join(staging, "checkpoints.json"), "w") as f:
+            json.dump(
+                [{"state_id": c.state_id, "image": c.image} for c in checkpoints], f
+            )
+        replaced = []
+        if os.path.exists(entry):
+            with open(os.path.join(entry, "checkpoints.json")) as f:
+                replaced = [c["image"] for c in json.load(f)]
+            shutil.rmtree(entry)
+        os.rename(staging, entry)
+        remove_images(
+            client, set(replaced) - {checkpoint.image for checkpoint in checkpoints}
+        )
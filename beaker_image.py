@@ -0,0 +1,90 @@
+import os
+
+import docker
+
+from container_pool import remove_container
+from exec_stream import stream_exec
+from module import PuppetModuleTest
+from workspace import Workspace
+
+BEAKER_REPOSITORY = "thefuzz-beaker"
+BEAKER_PLATFORM = "ubuntu-22.04-amd64"
+
+## An empty example, running it only runs beaker's provisioning and the module's suite hooks
+PROVISION_SPEC = """require 'spec_helper_acceptance'
+
+describe 'thefuzz provisioning' do
+  it 'provisions the host' do
+  end
+end
+"""
+
+
+def beaker_image(module: PuppetModuleTest) -> str:
+    return f"{BEAKER_REPOSITORY}:{module.name}-{module.bundle_key()}"
+
+
+def write_nodeset(path: str, image: str) -> None:
+    """A beaker nodeset starting the host from a provisioned image, as is"""
+    with open(path, "w") as f:
+        f.write(
+            "HOSTS:\n"
+            "  ubuntu2204-64-1:\n"
+            f"    platform: {BEAKER_PLATFORM}\n"
+            "    hypervisor: docker\n"
+            f"    image: {image}\n"
+            "    use_image_as_is: true\n"
+            "    roles:\n"
+            "      - agent\n"
+            "CONFIG:\n"
+            "  type: aio\n"
+        )
+
+
+def find_beaker_container(client):
+    for container in client.containers.list():
+        if "beaker" in container.attrs["Name"]:
+            return container
+    return None
+
+
+def provision_beaker_image(
+    client,
+    host,
+    module: PuppetModuleTest,
+    workspace: Workspace,
+    exec_env: dict,
+    timeout=None,
+):
+    """
+    Make sure the provisioned beaker host of a module exists as an image
+    The first time, beaker provisions a host for an empty example, which is then committed
+    Returns the image, or None if provisioning failed and the trial has to provision itself
+    """
+    image = beaker_image(module)
+    try:
+        client.images.get(image)
+        return image
+    except docker.errors.ImageNotFound:
+        pass
+
+    print(f"Provisioning the beaker host of {module.name}, once")
+    with open(os.path.join(workspace.host_mnt, "thefuzz_provision_spec.rb"), "w") as f:
+        f.write(PROVISION_SPEC)
+    run = stream_exec(
+        client,
+        host,
+        module.get_exec_command(spec="/mnt/thefuzz_provision_spec.rb"),
+        os.path.join(workspace.host_mnt, "provision_logs.txt"),
+        environment=exec_env,
+        timeout=timeout,
+    )
+    container = find_beaker_container(client)
+    if container is None or run.aborted is not None or run.watcher.crashed:
+        if container is not None:
+            remove_container(container)
+        return None
+    repository, tag = image.split(":")
+    container.commit(repository=repository, tag=tag)
+    remove_container(container)
+    return image
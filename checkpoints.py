@@ -0,0 +1,221 @@
+import filecmp
+import os
+import threading
+import time
+
+import docker
+import yaml
+
+from collect_state import SNAPSHOT_LOG_NAME, SnapshotLog, snapshot_count
+from module import BaseModuleTest
+from workspace import Workspace
+
+CHECKPOINT_REPOSITORY = "thefuzz-checkpoint"
+
+## Skipping a task that has one of these keys would lose state that lives on the host, not on the target
+HOST_STATE_KEYS = {
+    "register",
+    "notify",
+    "set_fact",
+    "ansible.builtin.set_fact",
+    "include_vars",
+    "ansible.builtin.include_vars",
+    "add_host",
+    "group_by",
+    "meta",
+}
+## Tasks that pull in other tasks cannot be skipped as a whole reliably
+INCLUDE_KEYS = {
+    "include",
+    "include_tasks",
+    "import_tasks",
+    "include_role",
+    "import_role",
+    "block",
+}
+
+
+class Checkpoint:
+    """The target container, committed to an image right after a snapshot of the baseline"""
+
+    def __init__(self, state_id: int, image: str) -> None:
+        self.state_id = state_id
+        self.image = image
+
+
+class ResumePlan:
+    """How a transformed trial skips the tasks it shares with the baseline"""
+
+    def __init__(self, checkpoint: Checkpoint, skipped_tasks: int) -> None:
+        self.checkpoint = checkpoint
+        self.skipped_tasks = skipped_tasks
+
+
+def is_snapshot_task(task) -> bool:
+    """The collect_state.py script, or the raw task triggering the collector agent"""
+    return isinstance(task, dict) and (
+        str(task.get("script", "")).startswith("collect_state.py")
+        or "collect_state.py" in str(task.get("raw", ""))
+    )
+
+
+def load_tasks(role_path: str):
+    """Returns the tasks of the role's tasks/main.yml, or None if it cannot be used for checkpoints"""
+    tasks_file = os.path.join(role_path, "tasks", "main.yml")
+    if not os.path.exists(tasks_file):
+        return None
+    try:
+        with open(tasks_file) as f:
+            tasks = yaml.safe_load(f)
+    except yaml.YAMLError:
+        return None
+    if not isinstance(tasks, list):
+        return None
+    return tasks
+
+
+def has_dependencies(role_path: str) -> bool:
+    """Role dependencies run again on resume, e.g. setup_remote_tmp_dir would create a new temp dir"""
+    meta_file = os.path.join(role_path, "meta", "main.yml")
+    if not os.path.exists(meta_file):
+        return False
+    with open(meta_file) as f:
+        meta = yaml.safe_load(f)
+    return isinstance(meta, dict) and bool(meta.get("dependencies"))
+
+
+def changed_files(baseline_path: str, trial_path: str) -> set:
+    """Relative paths of the files that differ between two copies of a role"""
+    changed = set()
+    for path, base in ((trial_path, baseline_path), (baseline_path, trial_path)):
+        for currentpath, _, files in os.walk(path):
+            for filename in files:
+                relpath = os.path.relpath(os.path.join(currentpath, filename), path)
+                other = os.path.join(base, relpath)
+                if not os.path.exists(other) or not filecmp.cmp(
+                    os.path.join(currentpath, filename), other, shallow=False
+                ):
+                    changed.add(relpath)
+    return changed
+
+
+def plan_resume(baseline_path: str, trial_path: str, checkpoints: list):
+    """
+    Find the last checkpoint before the first task the transformation modified
+    Returns None if the trial has to run from the start
+    """
+    if len(checkpoints) == 0 or has_dependencies(trial_path):
+        return None
+    # Anything but the task list changed (environment, fixtures, variables...), run everything
+    if changed_files(baseline_path, trial_path) != {os.path.join("tasks", "main.yml")}:
+        return None
+    baseline_tasks = load_tasks(baseline_path)
+    trial_tasks = load_tasks(trial_path)
+    if baseline_tasks is None or trial_tasks is None:
+        return None
+
+    first_change = 0
+    while (
+        first_change < min(len(baseline_tasks), len(trial_tasks))
+        and baseline_tasks[first_change] == trial_tasks[first_change]
+    ):
+        first_change += 1
+
+    plan = None
+    snapshots = 0
+    for position, task in enumerate(baseline_tasks[:first_change]):
+        if not isinstance(task, dict) or task.keys() & (HOST_STATE_KEYS | INCLUDE_KEYS):
+            break
+        if is_snapshot_task(task):
+            snapshots += 1
+            if snapshots <= len(checkpoints):
+                plan = ResumePlan(checkpoints[snapshots - 1], position + 1)
+    return plan
+
+
+def apply_resume_plan(
+    plan: ResumePlan, trial_path: str, baseline_snapshots: str, workspace: Workspace
+):
+    """
+    Drop the skipped tasks from the trial's role and seed its snapshots with the baseline's,
+    the collector then numbers the following snapshots as if the role had run from the start
+    """
+    tasks = load_tasks(trial_path)
+    with open(os.path.join(trial_path, "tasks", "main.yml"), "w") as f:
+        yaml.safe_dump(tasks[plan.skipped_tasks :], f, default_flow_style=False)
+    os.makedirs(workspace.snapshots, exist_ok=True)
+    SnapshotLog(os.path.join(baseline_snapshots, SNAPSHOT_LOG_NAME)).copy_to(
+        os.path.join(workspace.snapshots, SNAPSHOT_LOG_NAME),
+        plan.checkpoint.state_id + 1,
+    )
+
+
+def remove_images(client, images) -> None:
+    """Remove checkpoint images, by name or ID, leaving those a container still runs from"""
+    for image in images:
+        try:
+            client.images.remove(image)
+        except docker.errors.APIError:
+            pass
+
+
+def run_with_checkpoints(execute, target, workspace: Workspace, tag: str):
+    """
+    Run the baseline with execute(), committing the target to an image every time a snapshot is written
+    The collector waits for our acknowledgement, so the image holds exactly the snapshot's state
+    An image of an earlier baseline with the same tag is removed once its name is taken over.
+    If execute() raises, so does this, and the images committed so far are removed.
+    """
+    checkpoint_dir = os.path.join(workspace.target_mnt, "checkpoints")
+    os.makedirs(checkpoint_dir, exist_ok=True)
+    open(os.path.join(checkpoint_dir, "enabled"), "w").close()
+
+    result = {}
+
+    def run():
+        try:
+            result["output"] = execute()
+        except BaseException as e:
+            result["error"] = e
+
+    runner = threading.Thread(target=run)
+    runner.start()
+
+    snapshot_log = os.path.join(workspace.snapshots, SNAPSHOT_LOG_NAME)
+    checkpoints = []
+    while True:
+        running = runner.is_alive()
+        state_id = len(checkpoints)
+        if snapshot_count(snapshot_log) > state_id:
+            image = f"{CHECKPOINT_REPOSITORY}:{tag}-{state_id}"
+            try:
+                replaced = target.client.images.get(image).id
+            except docker.errors.ImageNotFound:
+                replaced = None
+            target.commit(repository=CHECKPOINT_REPOSITORY, tag=f"{tag}-{state_id}")
+            if replaced is not None:
+                remove_images(target.client, [replaced])
+            checkpoints.append(Checkpoint(state_id, image))
+            open(os.path.join(checkpoint_dir, f"ack_{state_id}"), "w").close()
+            continue
+        if not running:
+            break
+        time.sleep(0.1)
+    runner.join()
+    os.remove(os.path.join(checkpoint_dir, "enabled"))
+    if "error" in result:
+        remove_images(target.client, [checkpoint.image for checkpoint in checkpoints])
+        raise result["error"]
+    return result["output"], checkpoints
+
+
+def start_checkpoint_target(
+    client, checkpoint: Checkpoint, workspace: Workspace, labels: dict
+):
+    """Start a target from a checkpoint, in place of the pool's fresh target"""
+    target_mount = [
+        docker.types.Mount("/mnt", os.path.abspath(workspace.target_mnt), type="bind"),
+    ]
+    return client.containers.run(
+        checkpoint.image, mounts=target_mount, detach=True, labels=labels
+    )
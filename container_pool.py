@@ -0,0 +1,200 @@
+import itertools
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import docker
+
+from workspace import Workspace
+
+
+class ContainerPair:
+    """A host container and a target container, both mounting the same workspace"""
+
+    def __init__(self, host, target) -> None:
+        self.host = host
+        self.target = target
+        # A host may run several trials before it is replaced
+        self.host_uses = 0
+        self.host_image = None
+        self.docker_socket = False
+
+
+class ContainerPool:
+    """
+    Keeps a pre-started host/target pair ready for every workspace.
+    Once a trial is done with its pair, the pair is recycled in the background:
+    the target is always replaced by a fresh one, as it must never be reused dirty,
+    while the host is kept unless it is dirty or has been used too often.
+    Only the hosts of Puppet trials, where beaker creates the target itself, get the docker socket:
+    the pairs are started with it if docker_socket is set, and their host replaced when a trial needs otherwise.
+    """
+
+    def __init__(
+        self,
+        client,
+        workspaces: list,
+        labels: dict,
+        env: dict,
+        host_image="testing:host",
+        target_image="testing:target",
+        max_host_uses=50,
+        bundle_volume="thefuzz-bundle",
+        docker_socket=False,
+    ) -> None:
+        self.client = client
+        self.labels = labels
+        self.env = env
+        self.host_image = host_image
+        self.target_image = target_image
+        self.max_host_uses = max_host_uses
+        self.bundle_volume = bundle_volume
+        self.docker_socket = docker_socket
+        self.counter = itertools.count()
+        self.executor = ThreadPoolExecutor(max_workers=max(1, len(workspaces)))
+        self.ready = {
+            workspace.slot: self.executor.submit(self._start_pair, workspace)
+            for workspace in workspaces
+        }
+
+    def _start_host(self, workspace: Workspace, image=None, docker_socket=False):
+        # The bundle volume is only used by Puppet, it keeps the installed gems between trials
+        host_mount = [
+            docker.types.Mount(
+                "/mnt", os.path.abspath(workspace.host_mnt), type="bind"
+            ),
+            docker.types.Mount("/bundle", self.bundle_volume, type="volume"),
+        ]
+        # Whoever has the docker socket controls the docker daemon, only beaker needs it
+        if docker_socket:
+            host_mount.append(
+                docker.types.Mount(
+                    "/var/run/docker.sock", "/var/run/docker.sock", "bind"
+                )
+            )
+        return self.client.containers.run(
+            image or self.host_image,
+            name=f"{workspace.container_prefix}-host-{next(self.counter)}",
+            mounts=host_mount,
+            detach=True,
+            environment=self.env,
+            labels=self.labels,
+        )
+
+    def _start_target(self, workspace: Workspace, expose_ssh=True):
+        target_mount = [
+            docker.types.Mount(
+                "/mnt", os.path.abspath(workspace.target_mnt), type="bind"
+            ),
+        ]
+        ## Expose target's port 22 on a port unique to this workspace on local PC
+        return self.client.containers.run(
+            self.target_image,
+            name=f"{workspace.container_prefix}-target-{next(self.counter)}",
+            ports={"22/tcp": workspace.ssh_port} if expose_ssh else {},
+            mounts=target_mount,
+            detach=True,
+            labels=self.labels,
+        )
+
+    def _start_pair(self, workspace: Workspace) -> ContainerPair:
+        pair = ContainerPair(
+            self._start_host(workspace, docker_socket=self.docker_socket),
+            self._start_target(workspace),
+        )
+        pair.host_image = self.host_image
+        pair.docker_socket = self.docker_socket
+        return pair
+
+    def _recycle(
+        self, workspace: Workspace, pair: ContainerPair, target_used, host_dirty
+    ) -> ContainerPair:
+        try:
+            return self._renew(workspace, pair, target_used, host_dirty)
+        except Exception:
+            # Whatever is left of the pair would hold the workspace's port and names
+            for container in (pair.host, pair.target):
+                try:
+                    remove_container(container)
+                except docker.errors.APIError:
+                    pass
+            raise
+
+    def _renew(
+        self, workspace: Workspace, pair: ContainerPair, target_used, host_dirty
+    ) -> ContainerPair:
+        if host_dirty or pair.host_uses >= self.max_host_uses:
+            remove_container(pair.host)
+            pair.host = self._start_host(workspace, pair.host_image, pair.docker_socket)
+            pair.host_uses = 0
+        if target_used:
+            # The target's port is bound to the workspace, so the old one must go first
+            remove_container(pair.target)
+            pair.target = self._start_target(workspace)
+        return pair
+
+    def acquire(
+        self, workspace: Workspace, host_image=None, docker_socket=False
+    ) -> ContainerPair:
+        """
+        Hand out the warm pair of a workspace, waiting for it if it is still starting
+        If the trial needs another host image, e.g. a reproduction image, or needs the docker socket
+        when the host does not have it (or the other way around), the host is replaced first
+        If the pair could not be made ready, its error is raised, and a fresh pair is started for the next trial
+        """
+        try:
+            pair = self.ready[workspace.slot].result()
+        except Exception:
+            self.ready[workspace.slot] = self.executor.submit(
+                self._start_pair, workspace
+            )
+            raise
+        del self.ready[workspace.slot]
+        host_image = host_image or self.host_image
+        if pair.host_image != host_image or pair.docker_socket != docker_socket:
+            try:
+                remove_container(pair.host)
+                pair.host = self._start_host(workspace, host_image, docker_socket)
+            except Exception:
+                # Hand the pair back, its host is replaced in the background
+                self.release(workspace, pair, target_used=False, host_dirty=True)
+                raise
+            pair.host_image = host_image
+            pair.docker_socket = docker_socket
+            pair.host_uses = 0
+        pair.host_uses += 1
+        return pair
+
+    def start_extra_target(self, workspace: Workspace):
+        """A target outside of the pool, e.g. for fan-out runs, to be removed by the caller"""
+        return self._start_target(workspace, expose_ssh=False)
+
+    def release(
+        self,
+        workspace: Workspace,
+        pair: ContainerPair,
+        target_used=True,
+        host_dirty=False,
+    ) -> None:
+        """Give back a pair, it is made ready again in the background"""
+        self.ready[workspace.slot] = self.executor.submit(
+            self._recycle, workspace, pair, target_used, host_dirty
+        )
+
+    def close(self) -> None:
+        for future in self.ready.values():
+            try:
+                pair = future.result()
+            except docker.errors.APIError:
+                continue
+            remove_container(pair.host)
+            remove_container(pair.target)
+        self.ready = {}
+        self.executor.shutdown()
+
+
+def remove_container(container):
+    try:
+        container.stop()
+        container.remove()
+    except docker.errors.NotFound:
+        pass
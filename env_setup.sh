@@ -1,15 +1,3 @@
 #! /bin/sh
 
-if [ "$REPRODUCE" == "lineinfile" ]
-  then
-    ## We are reproducing the "./" bug in lineinfile
-    ## First we must revert the code that fixes the issue in lineinfile.py
-    echo "reproducing lineinfile bug"
-    bash /mnt/reproduce_lineinfile.sh
-elif [ "$REPRODUCE" == "rhsm" ]
-  then
-    ## We are reproducing the locale bug in rhsm
-    ## First we must revert the code that fixes the issue in rhsm_repository.py
-    echo "reproducing rhsm bug"
-    bash /mnt/reproduce_rhsm.sh
-fi
\ No newline at end of file
+## Reproduction scenarios are built once, see the reproduce entries of config_lineinfile.yaml and config_rhsm.yaml
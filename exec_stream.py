@@ -0,0 +1,148 @@
+import codecs
+import queue
+import re
+import threading
+import time
+
+## Ansible's play recap, e.g. "localhost : ok=3 changed=1 unreachable=0 failed=0 skipped=0 ..."
+UNREACHABLE_PATTERN = re.compile(r"\bunreachable=(\d+)")
+FAILED_PATTERN = re.compile(r"\bfailed=(\d+)")
+## rspec's summary, e.g. "12 examples, 0 failures"
+RSPEC_SUMMARY_PATTERN = re.compile(r"\b(\d+) examples?, (\d+) failures?")
+## rspec's list of failed examples, e.g. "rspec ./spec/acceptance/class_spec.rb:12 # class works idempotently"
+RSPEC_FAILED_EXAMPLE_PATTERN = re.compile(r"^rspec \S+ # (.*)$")
+
+
+class LogWatcher:
+    """
+    Incremental parser of the output of a test run
+    A run that never printed a recap or a summary did not finish, and counts as a crash
+    """
+
+    def __init__(self) -> None:
+        self.recaps = 0
+        self.failed = 0
+        self.unreachable = 0
+        self.examples = None
+        self.failures = 0
+        self.failed_examples = []
+        self._partial = ""
+
+    def feed(self, text: str) -> None:
+        lines = (self._partial + text).split("\n")
+        self._partial = lines.pop()
+        for line in lines:
+            self.parse_line(line)
+
+    def close(self) -> None:
+        if self._partial:
+            self.parse_line(self._partial)
+            self._partial = ""
+
+    def parse_line(self, line: str) -> None:
+        if "ok=" in line:
+            unreachable = UNREACHABLE_PATTERN.search(line)
+            failed = FAILED_PATTERN.search(line)
+            if unreachable and failed:
+                self.recaps += 1
+                self.unreachable += int(unreachable.group(1))
+                self.failed += int(failed.group(1))
+        summary = RSPEC_SUMMARY_PATTERN.search(line)
+        if summary:
+            self.examples = (self.examples or 0) + int(summary.group(1))
+            self.failures += int(summary.group(2))
+        failed_example = RSPEC_FAILED_EXAMPLE_PATTERN.match(line.strip())
+        if failed_example:
+            self.failed_examples.append(failed_example.group(1))
+
+    @property
+    def finished(self) -> bool:
+        return self.recaps > 0 or self.examples is not None
+
+    @property
+    def failing(self) -> bool:
+        """A failure was reported, nothing printed later can make the run succeed"""
+        return self.failed > 0 or self.unreachable > 0 or self.failures > 0
+
+    @property
+    def crashed(self) -> bool:
+        return self.failing or not self.finished
+
+
+class StreamedRun:
+    """The result of a test command: its exit code, the parsed output, and why it was cut short, if it was"""
+
+    def __init__(self, exit_code, watcher: LogWatcher, aborted=None) -> None:
+        self.exit_code = exit_code
+        self.watcher = watcher
+        self.aborted = aborted
+
+    @property
+    def timed_out(self) -> bool:
+        return self.aborted in ("timeout", "idle_timeout")
+
+
+def stream_exec(
+    client,
+    container,
+    command: str,
+    log_path: str,
+    environment=None,
+    timeout=None,
+    idle_timeout=None,
+) -> StreamedRun:
+    """
+    Run a command in a container, writing its output to log_path as it arrives
+    The run is abandoned after timeout seconds, or after idle_timeout seconds without output.
+    A failure is not a reason to stop: Ansible reports it in its recap, once the run is over anyway,
+    and the callback writes its stats after it. An abandoned command keeps running,
+    so the container must not be reused.
+    """
+    exec_id = client.api.exec_create(container.id, command, environment=environment)[
+        "Id"
+    ]
+    stream = client.api.exec_start(exec_id, stream=True)
+
+    ## The stream blocks while the command is silent, it is read in a thread so the timeouts can fire
+    chunks = queue.Queue()
+
+    def read():
+        try:
+            for chunk in stream:
+                chunks.put(chunk)
+        finally:
+            chunks.put(None)
+
+    threading.Thread(target=read, daemon=True).start()
+
+    watcher = LogWatcher()
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+    started = last_output = time.time()
+    aborted = None
+    with open(log_path, "w") as log:
+        while True:
+            now = time.time()
+            if timeout is not None and now - started >= timeout:
+                aborted = "timeout"
+                break
+            if idle_timeout is not None and now - last_output >= idle_timeout:
+                aborted = "idle_timeout"
+                break
+            try:
+                chunk = chunks.get(timeout=1)
+            except queue.Empty:
+                continue
+            if chunk is None:
+                break
+            text = decoder.decode(chunk)
+            log.write(text)
+            log.flush()
+            watcher.feed(text)
+            last_output = time.time()
+        log.write(decoder.decode(b"", final=True))
+    watcher.close()
+
+    exit_code = None
+    if aborted is None:
+        exit_code = client.api.exec_inspect(exec_id)["ExitCode"]
+    return StreamedRun(exit_code, watcher, aborted)
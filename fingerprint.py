@@ -0,0 +1,40 @@
+import hashlib
+import os
+
+
+class TreeFingerprinter:
+    """
+    Content hashes of directory trees.
+    Every file is read: the workspaces are wiped and rebuilt for every trial, so their inodes are reused
+    and their copies keep the modification times of the originals, nothing cheaper tells their contents apart.
+    """
+
+    def file_digest(self, path: str) -> str:
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    def file_digests(self, root: str) -> dict:
+        """Content hash of every file of a tree, indexed by its path relative to root"""
+        digests = {}
+        for currentpath, _, files in os.walk(root):
+            for filename in files:
+                filepath = os.path.join(currentpath, filename)
+                if os.path.islink(filepath):
+                    digests[os.path.relpath(filepath, root)] = "link:" + os.readlink(
+                        filepath
+                    )
+                else:
+                    digests[os.path.relpath(filepath, root)] = self.file_digest(
+                        filepath
+                    )
+        return digests
+
+    def tree_digest(self, root: str) -> str:
+        """A single hash of the names and contents of every file of a tree"""
+        digest = hashlib.sha256()
+        for relpath, file_digest in sorted(self.file_digests(root).items()):
+            digest.update(relpath.encode() + b"\0" + file_digest.encode() + b"\0")
+        return digest.hexdigest()
@@ -0,0 +1,73 @@
+# Writes one JSON line per task result to $THEFUZZ_RESULTS, for thefuzz to read instead of the logs
+import json
+import os
+import time
+
+from ansible.plugins.callback import CallbackBase
+
+DOCUMENTATION = """
+    name: thefuzz_results
+    type: aggregate
+    short_description: JSON lines of task results and timings
+    description:
+      - One line per task result (status, changed, duration, module), and one line per host with the play recap
+    requirements:
+      - enable in configuration, and set THEFUZZ_RESULTS to the output file
+"""
+
+
+class CallbackModule(CallbackBase):
+    CALLBACK_VERSION = 2.0
+    CALLBACK_TYPE = "aggregate"
+    CALLBACK_NAME = "thefuzz_results"
+    CALLBACK_NEEDS_ENABLED = True
+
+    def __init__(self):
+        super(CallbackModule, self).__init__()
+        self.path = os.getenv("THEFUZZ_RESULTS", "/mnt/task_results.jsonl")
+        self.started = {}
+        # Counted per host: with the free strategy, the hosts of a fan-out run do not take the tasks in step
+        self.positions = {}
+
+    def write(self, entry):
+        with open(self.path, "a") as f:
+            f.write(json.dumps(entry) + "\n")
+
+    def v2_runner_on_start(self, host, task):
+        host = host.get_name()
+        self.positions[host] = self.positions.get(host, 0) + 1
+        self.started[(host, task._uuid)] = (time.time(), self.positions[host])
+
+    def record(self, result, status, ignore_errors=False):
+        task = result._task
+        host = result._host.get_name()
+        started, position = self.started.pop((host, task._uuid), (None, None))
+        self.write(
+            {
+                "event": "result",
+                "position": position,
+                "host": host,
+                "task": task.get_name(),
+                "module": task.action,
+                "status": status,
+                "changed": bool(result._result.get("changed", False)),
+                "ignore_errors": bool(ignore_errors),
+                "duration": round(time.time() - started, 3) if started else None,
+            }
+        )
+
+    def v2_runner_on_ok(self, result):
+        self.record(result, "ok")
+
+    def v2_runner_on_failed(self, result, ignore_errors=False):
+        self.record(result, "failed", ignore_errors)
+
+    def v2_runner_on_skipped(self, result):
+        self.record(result, "skipped")
+
+    def v2_runner_on_unreachable(self, result):
+        self.record(result, "unreachable", result._task.ignore_unreachable)
+
+    def v2_playbook_on_stats(self, stats):
+        for host in sorted(stats.processed.keys()):
+            self.write({"event": "stats", "host": host, **stats.summarize(host)})
@@ -0,0 +1,5 @@
+#! /bin/sh
+## Built into testing:host-repro-lineinfile, see the reproduce entry of config_lineinfile.yaml
+
+## Remove the line that fixes the "./" bug in lineinfile.py
+sed -i '/if b_destpath and not os.path.exists(b_destpath) and not module.check_mode:/c\        if not os.path.exists(b_destpath) and not module.check_mode:' /usr/local/lib/python3.10/site-packages/ansible/modules/lineinfile.py
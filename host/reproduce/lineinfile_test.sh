@@ -0,0 +1,25 @@
+#! /bin/sh
+## Applied once to a copy of the lineinfile test, given as $1, see the reproduce entry of config_lineinfile.yaml
+
+## Remove the testcases that were added after discovering the bug
+python3 -c "
+import sys
+print('Removing New test cases that were added afrer bug')
+flag = 1
+newlines = []
+count = 0
+with open(sys.argv[1] + '/tasks/main.yml') as infile:
+  linelist = infile.readlines()
+  for line in linelist:
+    if '- name: Create a file without a path' in line:
+      flag = 0
+    if flag:
+      newlines.append(line)
+    else:
+      count += 1
+    if '- create_no_path_file.stat.exists' in line:
+      flag = 1
+with open(sys.argv[1] + '/tasks/main.yml', 'w') as infile:
+  infile.writelines(newlines)
+print(f'{count} lines removed')
+" "$1"
@@ -0,0 +1,12 @@
+#! /bin/sh
+## Built into testing:host-repro-rhsm, see the reproduce entry of config_rhsm.yaml
+
+## Revert the fix of the locale bug in rhsm_repository.py: it runs subscription-manager with LANG=C,
+## so the module parses its English output whatever the language of the target
+module=$(find / -path /proc -prune -o -path '*/community/general/plugins/modules/*rhsm_repository.py' -print | head -n 1)
+if [ -z "$module" ] || ! grep -q "environ_update=lang_env" "$module"
+  then
+    echo "rhsm_repository.py, or the fix of its locale bug, was not found"
+    exit 1
+fi
+sed -i 's/, *environ_update=lang_env//' "$module"
@@ -0,0 +1,301 @@
+import argparse
+import json
+import sqlite3
+import time
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS trials (
+    id INTEGER PRIMARY KEY,
+    campaign TEXT,
+    module TEXT,
+    transformation TEXT,
+    parameters TEXT,
+    seed INTEGER,
+    test_digest TEXT,
+    edits INTEGER,
+    started REAL,
+    duration REAL,
+    outcome TEXT,
+    signature TEXT,
+    output_path TEXT,
+    digests TEXT,
+    artifacts TEXT,
+    slowest_tasks TEXT
+);
+CREATE INDEX IF NOT EXISTS trials_outcome ON trials (outcome, module, transformation);
+CREATE TABLE IF NOT EXISTS signatures (
+    module TEXT,
+    signature TEXT,
+    description TEXT,
+    first_output TEXT,
+    PRIMARY KEY (module, signature)
+);
+CREATE TABLE IF NOT EXISTS output_ids (
+    module TEXT,
+    transformation TEXT,
+    next_id INTEGER,
+    PRIMARY KEY (module, transformation)
+);
+"""
+
+## Outcomes that come with an output directory worth looking at
+FINDINGS = ("crash", "difference", "crash_and_difference", "timeout")
+## Findings whose signature was already seen, only counted
+DUPLICATE = "duplicate"
+
+
+class Ledger:
+    """
+    Every trial of the campaigns, in an SQLite database
+    WAL mode lets the worker threads (or several campaigns) write while reports are read,
+    each call opens its own connection, so the ledger can be shared between threads
+    """
+
+    def __init__(self, path: str, campaign=None) -> None:
+        self.path = path
+        self.campaign = campaign or time.strftime("%Y-%m-%dT%H:%M:%S")
+        with self.connect() as db:
+            db.execute("PRAGMA journal_mode=WAL")
+            db.executescript(SCHEMA)
+
+    def connect(self):
+        db = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+        db.row_factory = sqlite3.Row
+        return db
+
+    def next_output_id(self, module: str, transformation: str) -> int:
+        """The next number of the output directories of a module and transformation"""
+        db = self.connect()
+        try:
+            db.execute("BEGIN IMMEDIATE")
+            row = db.execute(
+                "SELECT next_id FROM output_ids WHERE module = ? AND transformation = ?",
+                (module, transformation),
+            ).fetchone()
+            output_id = row["next_id"] if row is not None else 0
+            db.execute(
+                "INSERT OR REPLACE INTO output_ids VALUES (?, ?, ?)",
+                (module, transformation, output_id + 1),
+            )
+            db.execute("COMMIT")
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        finally:
+            db.close()
+        return output_id
+
+    def record(
+        self,
+        module: str,
+        transformation: str,
+        parameters: dict,
+        seed,
+        started: float,
+        duration: float,
+        outcome: str,
+        output_path=None,
+        signature=None,
+        digests=None,
+        artifacts=None,
+        slowest_tasks=None,
+        test_digest=None,
+        edits=None,
+    ) -> None:
+        """test_digest and edits, the tree digest of the transformed test and its number of edits, let a replay check it rebuilt the same test"""
+        db = self.connect()
+        try:
+            db.execute(
+                "INSERT INTO trials (campaign, module, transformation, parameters, seed, test_digest,"
+                " edits, started, duration, outcome, signature, output_path, digests, artifacts,"
+                " slowest_tasks) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    self.campaign,
+                    module,
+                    transformation,
+                    json.dumps(parameters, default=str),
+                    seed,
+                    test_digest,
+                    edits,
+                    started,
+                    duration,
+                    outcome,
+                    signature,
+                    output_path,
+                    json.dumps(digests) if digests is not None else None,
+                    json.dumps(artifacts) if artifacts is not None else None,
+                    json.dumps(slowest_tasks) if slowest_tasks is not None else None,
+                ),
+            )
+        finally:
+            db.close()
+
+    def record_signature(
+        self, module: str, signature: str, description: list, output_path: str
+    ) -> None:
+        """The first finding of a signature, the later ones are only counted in the trials"""
+        db = self.connect()
+        try:
+            db.execute(
+                "INSERT OR IGNORE INTO signatures VALUES (?, ?, ?, ?)",
+                (module, signature, json.dumps(description), output_path),
+            )
+        finally:
+            db.close()
+
+    def finding_counts(self) -> dict:
+        """How many times each finding signature was found, indexed by (module, signature)"""
+        db = self.connect()
+        try:
+            rows = db.execute(
+                "SELECT module, signature, COUNT(*) AS findings FROM trials"
+                " WHERE signature IS NOT NULL"
+                f" AND outcome IN ({', '.join('?' * (len(FINDINGS) + 1))})"
+                " GROUP BY module, signature",
+                FINDINGS + (DUPLICATE,),
+            ).fetchall()
+        finally:
+            db.close()
+        return {(row["module"], row["signature"]): row["findings"] for row in rows}
+
+    def trial(self, trial_id: int):
+        """A trial as a dict, its JSON columns decoded, or None if there is no such trial"""
+        db = self.connect()
+        try:
+            row = db.execute(
+                "SELECT * FROM trials WHERE id = ?", (trial_id,)
+            ).fetchone()
+        finally:
+            db.close()
+        if row is None:
+            return None
+        trial = dict(row)
+        for column in ("parameters", "digests", "artifacts", "slowest_tasks"):
+            if trial[column] is not None:
+                trial[column] = json.loads(trial[column])
+        return trial
+
+
+def print_rows(rows, columns) -> None:
+    widths = [
+        max([len(column)] + [len(str(row[column])) for row in rows])
+        for column in columns
+    ]
+    print("  ".join(column.ljust(width) for column, width in zip(columns, widths)))
+    for row in rows:
+        print(
+            "  ".join(
+                str(row[column]).ljust(width) for column, width in zip(columns, widths)
+            )
+        )
+
+
+def triage(db, args) -> None:
+    """Findings grouped by module, transformation and outcome, with the most recent output"""
+    rows = db.execute(
+        "SELECT module, transformation, outcome, COUNT(*) AS trials,"
+        " MAX(output_path) AS latest_output FROM trials"
+        f" WHERE outcome IN ({', '.join('?' * len(FINDINGS))})"
+        " AND (? IS NULL OR module = ?) AND (? IS NULL OR campaign = ?)"
+        " GROUP BY module, transformation, outcome ORDER BY trials DESC",
+        FINDINGS + (args.module, args.module, args.campaign, args.campaign),
+    ).fetchall()
+    print_rows(rows, ["module", "transformation", "outcome", "trials", "latest_output"])
+
+
+def clusters(db, args) -> None:
+    """Findings grouped by signature: how often each was found, by which transformations, and where its first output is"""
+    rows = db.execute(
+        "SELECT trials.module, trials.signature, COUNT(*) AS findings,"
+        " GROUP_CONCAT(DISTINCT trials.transformation) AS transformations,"
+        " signatures.first_output FROM trials"
+        " JOIN signatures ON signatures.module = trials.module AND signatures.signature = trials.signature"
+        " WHERE (? IS NULL OR trials.module = ?) AND (? IS NULL OR trials.campaign = ?)"
+        " GROUP BY trials.module, trials.signature ORDER BY findings DESC",
+        (args.module, args.module, args.campaign, args.campaign),
+    ).fetchall()
+    print_rows(
+        rows, ["module", "signature", "findings", "transformations", "first_output"]
+    )
+
+
+def throughput(db, args) -> None:
+    """Trials, trial rate and mean trial duration of every campaign"""
+    rows = db.execute(
+        "SELECT campaign, COUNT(*) AS trials,"
+        f" SUM(outcome IN ({', '.join('?' * len(FINDINGS))})) AS findings,"
+        " SUM(outcome = ?) AS duplicates,"
+        " SUM(outcome = 'no_op') AS no_ops,"
+        " ROUND(AVG(duration), 1) AS mean_duration,"
+        " ROUND(COUNT(*) * 3600.0 / MAX(MAX(started + duration) - MIN(started), 1), 1) AS trials_per_hour"
+        " FROM trials WHERE (? IS NULL OR module = ?)"
+        " GROUP BY campaign ORDER BY campaign",
+        FINDINGS + (DUPLICATE, args.module, args.module),
+    ).fetchall()
+    print_rows(
+        rows,
+        [
+            "campaign",
+            "trials",
+            "findings",
+            "duplicates",
+            "no_ops",
+            "mean_duration",
+            "trials_per_hour",
+        ],
+    )
+
+
+def trials(db, args) -> None:
+    """The trials themselves, most recent first"""
+    rows = db.execute(
+        "SELECT id, campaign, module, transformation, seed, ROUND(duration, 1) AS duration,"
+        " outcome, output_path FROM trials"
+        " WHERE (? IS NULL OR module = ?) AND (? IS NULL OR outcome = ?)"
+        " AND (? IS NULL OR campaign = ?) ORDER BY id DESC LIMIT ?",
+        (
+            args.module,
+            args.module,
+            args.outcome,
+            args.outcome,
+            args.campaign,
+            args.campaign,
+            args.limit,
+        ),
+    ).fetchall()
+    print_rows(
+        rows,
+        [
+            "id",
+            "campaign",
+            "module",
+            "transformation",
+            "seed",
+            "duration",
+            "outcome",
+            "output_path",
+        ],
+    )
+
+
+REPORTS = {
+    "triage": triage,
+    "clusters": clusters,
+    "throughput": throughput,
+    "trials": trials,
+}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Reports on the trials of the ledger")
+    parser.add_argument("report", choices=sorted(REPORTS.keys()))
+    parser.add_argument("--ledger", default="output/ledger.sqlite")
+    parser.add_argument("--module")
+    parser.add_argument("--campaign")
+    parser.add_argument("--outcome")
+    parser.add_argument("--limit", type=int, default=50)
+    args = parser.parse_args()
+
+    db = sqlite3.connect(f"file:{args.ledger}?mode=ro", uri=True)
+    db.row_factory = sqlite3.Row
+    REPORTS[args.report](db, args)
@@ -0,0 +1,307 @@
+import copy
+import json
+import os
+import queue
+import threading
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+
+import docker
+import emoji
+
+import thefuzz
+from container_pool import ContainerPool
+from ledger import Ledger
+from reproduction import prepare_reproduction
+from workspace import create_workspaces
+
+
+def split(items: list, count: int) -> list:
+    """Split items into count chunks of nearly equal size, in order"""
+    chunks = []
+    start = 0
+    for i in range(count):
+        end = start + (len(items) - start) // (count - i)
+        chunks.append(items[start:end])
+        start = end
+    return chunks
+
+
+def first_reproducing(candidates: list, reproduces, executor, jobs: int):
+    """The first candidate that reproduces, trying up to jobs of them at a time"""
+    for start in range(0, len(candidates), jobs):
+        window = candidates[start : start + jobs]
+        for candidate, reproduced in zip(window, executor.map(reproduces, window)):
+            if reproduced:
+                return candidate
+    return None
+
+
+def ddmin(items: list, reproduces, jobs=1) -> list:
+    """
+    Zeller's delta debugging: a 1-minimal subset of items that still reproduces(),
+    which must hold for items itself
+    Each round tries the chunks, then their complements, up to jobs of them in parallel
+    """
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        count = 2
+        while len(items) >= 2:
+            chunks = split(items, count)
+            reduced = first_reproducing(chunks, reproduces, executor, jobs)
+            if reduced is not None:
+                items, count = reduced, 2
+                continue
+            # With two chunks, the complements are the chunks themselves
+            if count > 2:
+                complements = [
+                    [item for other in chunks[:i] + chunks[i + 1 :] for item in other]
+                    for i in range(len(chunks))
+                ]
+                reduced = first_reproducing(complements, reproduces, executor, jobs)
+                if reduced is not None:
+                    items, count = reduced, max(count - 1, 2)
+                    continue
+            if count >= len(items):
+                break
+            count = min(count * 2, len(items))
+    return items
+
+
+class Minimizer:
+    """
+    Replays a transformed trial with the seed it was recorded with, keeping only some of its edits
+    and overriding some of the values it generated, and checks whether it still finds the same signature
+    Each replay runs in a workspace of its own, so several can run at once
+    """
+
+    def __init__(
+        self, module, transformation, seed, signature, workspaces, pool
+    ) -> None:
+        self.module = module
+        self.transformation = transformation
+        self.seed = seed
+        self.signature = signature
+        self.workspaces = queue.Queue()
+        for workspace in workspaces:
+            self.workspaces.put(workspace)
+        self.pool = pool
+        self.replays = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def evaluate(module, transformation, workspace, timed_out=False):
+        return thefuzz.finding_signature(
+            thefuzz.trial_differences(module, transformation, workspace, timed_out)[3]
+        )
+
+    def replay(self, edit_filter=None, overrides=None):
+        """
+        Returns the finding signature of the replay (None if it found nothing), its edits,
+        its generated values and the tree digest of its transformed test
+        """
+        with self.lock:
+            self.replays += 1
+        workspace = self.workspaces.get()
+        try:
+            workspace.reset()
+            module = copy.copy(self.module)
+            transformation = copy.copy(self.transformation)
+            module.edit_filter = edit_filter
+            transformation.overrides = overrides or {}
+            thefuzz.apply_transformation(module, transformation, workspace, self.seed)
+            thefuzz.generate_playbook(module, workspace)
+            test_digest = thefuzz.FINGERPRINTER.tree_digest(module.copied_path)
+            client = docker.from_env()
+            if module.creates_container:
+                with thefuzz.PUPPET_LOCK:
+                    thefuzz.remove_leftover_containers(client, beaker_only=True)
+                    signature = thefuzz.run_tests_in_docker(
+                        client,
+                        module,
+                        transformation,
+                        workspace,
+                        self.pool,
+                        evaluate=self.evaluate,
+                    )
+            else:
+                signature = thefuzz.run_tests_in_docker(
+                    client,
+                    module,
+                    transformation,
+                    workspace,
+                    self.pool,
+                    evaluate=self.evaluate,
+                )
+            return signature, module.edits, transformation.generated, test_digest
+        finally:
+            self.workspaces.put(workspace)
+
+    def reproduces(self, edit_ids, overrides=None) -> bool:
+        try:
+            signature, _, _, _ = self.replay(set(edit_ids), overrides)
+        except Exception as e:
+            print("Replay failed")
+            print(e)
+            return False
+        return signature == self.signature
+
+
+def find_arm(module_trans: dict, trial: dict):
+    """The module and transformation of the config a trial of the ledger was run with"""
+    for module, transformations in module_trans.items():
+        if module.name != trial["module"]:
+            continue
+        for transformation in transformations:
+            parameters = json.loads(
+                json.dumps(transformation.parameters(), default=str)
+            )
+            if (
+                transformation.name == trial["transformation"]
+                and parameters == trial["parameters"]
+            ):
+                return module, transformation
+    raise Exception(
+        f"No {trial['transformation']} transformation of {trial['module']} with these parameters in the config"
+    )
+
+
+def minimize(minimizer: Minimizer, trial: dict, jobs: int) -> dict:
+    """
+    The smallest subset of the trial's edits that still finds the same signature,
+    then the shortest version of each generated value these edits use
+    The replay must first rebuild the very test the trial ran, or there is nothing to minimize
+    """
+    signature, edits, generated, test_digest = minimizer.replay()
+    if trial["test_digest"] is not None and (
+        test_digest != trial["test_digest"] or len(edits) != trial["edits"]
+    ):
+        raise Exception(
+            f"The replay made {len(edits)} edits to a test with digest {test_digest}, "
+            f"the trial made {trial['edits']} to a test with digest {trial['test_digest']}: "
+            "it was not run with the same config, snapshot options or module sources"
+        )
+    if signature != minimizer.signature:
+        raise Exception(
+            f"The replay found {signature} instead of {minimizer.signature}, the finding is not reproducible"
+        )
+    print(f"Minimizing {len(edits)} edits")
+    edit_ids = ddmin([edit["id"] for edit in edits], minimizer.reproduces, jobs)
+
+    overrides = {}
+    used = [edit for edit in edits if edit["id"] in edit_ids]
+    for position, value in enumerate(generated):
+        if value == "" or not any(value in edit["replacement"] for edit in used):
+            continue
+        print(f"Shortening the generated value {value!r}")
+
+        def reproduces(kept, position=position, value=value):
+            shorter = "".join(value[i] for i in kept)
+            return minimizer.reproduces(edit_ids, {**overrides, position: shorter})
+
+        kept = ddmin(list(range(len(value))), reproduces, jobs)
+        overrides[position] = "".join(value[i] for i in kept)
+
+    # Describe the minimal edits as they are made with the shortened values
+    signature, edits, _, _ = minimizer.replay(set(edit_ids), overrides)
+    return {
+        "signature": signature,
+        "seed": minimizer.seed,
+        "edits": edits,
+        "overrides": overrides,
+        "replays": minimizer.replays,
+    }
+
+
+def parse_args():
+    parser = ArgumentParser(
+        description="Find the smallest set of edits of a trial that still finds the same signature"
+    )
+    parser.add_argument("trial", type=int, help="ID of the trial in the ledger")
+    parser.add_argument("-c", "--config", default="config.yaml")
+    parser.add_argument("--ledger", default="output/ledger.sqlite")
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=1,
+        help="Number of replays to run concurrently",
+    )
+    parser.add_argument("--workspaces", default="workspaces_minimize")
+    parser.add_argument("--reproduce-dir", default=".thefuzz_cache/reproduce")
+    parser.add_argument(
+        "--hash-algorithm",
+        default="md5",
+        help="Must be the one of the campaign, for the snapshots to compare to its baseline",
+    )
+    parser.add_argument("--file-metadata", action="store_true")
+    parser.add_argument(
+        "--no-snapshot-agent",
+        action="store_true",
+        help="Must be given if it was given to the campaign, the snapshot tasks are part of the test",
+    )
+    parser.add_argument("--no-beaker-image", action="store_true")
+    parser.add_argument("--timeout", type=float, default=3600)
+    parser.add_argument("--idle-timeout", type=float, default=900)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    ledger = Ledger(args.ledger)
+    trial = ledger.trial(args.trial)
+    if trial is None or trial["signature"] is None:
+        raise Exception(f"Trial {args.trial} has no finding to minimize")
+
+    module_trans = thefuzz.transformations_per_module(thefuzz.read_config(args.config))
+    module, transformation = find_arm(module_trans, trial)
+
+    ## Replays run like the trials of the campaign, against its baseline
+    thefuzz.SNAPSHOT_ARGS = f"--hash-algorithm {args.hash_algorithm}"
+    if args.file_metadata:
+        thefuzz.SNAPSHOT_ARGS += " --file-metadata"
+    thefuzz.SNAPSHOT_AGENT = not args.no_snapshot_agent
+    thefuzz.BEAKER_IMAGES = not args.no_beaker_image
+    thefuzz.TRIAL_TIMEOUT = args.timeout
+    thefuzz.IDLE_TIMEOUT = args.idle_timeout
+    thefuzz.MODULE_BASELINES[module.name] = thefuzz.grab_states(
+        f"output/{module.name}/baseline/snapshots"
+    )
+    thefuzz.prepare_module(module)
+    if module.reproduce is not None:
+        prepare_reproduction(
+            docker.from_env(), module, module.reproduce, args.reproduce_dir
+        )
+
+    thefuzz.create_empty_folder(args.workspaces)
+    workspaces = create_workspaces(args.workspaces, args.jobs)
+    pool = ContainerPool(
+        docker.from_env(),
+        workspaces,
+        labels={thefuzz.CONTAINER_LABEL: str(os.getpid())},
+        env={"REPRODUCE": os.getenv("REPRODUCE")},
+        docker_socket=module.creates_container,
+    )
+    try:
+        minimizer = Minimizer(
+            module, transformation, trial["seed"], trial["signature"], workspaces, pool
+        )
+        result = minimize(minimizer, trial, args.jobs)
+    finally:
+        pool.close()
+
+    output_path = f"output/{module.name}/minimized"
+    os.makedirs(output_path, exist_ok=True)
+    with open(f"{output_path}/trial{args.trial:09d}.json", "w") as f:
+        json.dump({"trial": args.trial, **result}, f, indent=1, ensure_ascii=False)
+    print(
+        emoji.emojize("✂️"),
+        f" {len(result['edits'])} edits reproduce finding {result['signature']}, after {result['replays']} replays:",
+    )
+    for edit in result["edits"]:
+        print(
+            f"  {edit['kind']} in {edit['file']}: {edit['original']!r} -> {edit['replacement']!r}"
+        )
+
+
+if __name__ == "__main__":
+    main()
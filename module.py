@@ -1,9 +1,16 @@
+import hashlib
+import json
 import os
-import fileinput
 import shutil
 import sys
 import re
 
+from ruamel.yaml import YAML
+
+from role_model import RoleModel
+from spec_index import SpecIndex
+from workspace import clone_tree
+
 
 class BaseModuleTest:
     """Integration tests for a module."""
@@ -20,14 +27,42 @@ class BaseModuleTest:
         self.code_extension = code_extension
         self.creates_container = creates_container
         self.extra_path = extra_path
+        # Folders the snapshots collect the file tree from, None for the working directory
+        self.snapshot_roots = None
+        # Where trials copy the test from, when it is not base_path (e.g. a patched reproduction copy)
+        self.source_path = None
+        # Host image of the module's trials, None for the pool's default
+        self.host_image = None
+        # Reproduction scenario of the config: name, image_script and test_script
+        self.reproduce = None
+        # The edits the replace methods made to the copy, and, when a trial is replayed,
+        # the IDs of the only edits to make (see minimize.py)
+        self.edits = []
+        self.edit_filter = None
+        self.edit_call = None
+        # (new path, old path) of every rename, relative to the copy, to name the edits after the original files
+        self.moves = []
+        # Tree digest of the transformed copy, once the campaign fingerprinted it
+        self.test_digest = None
+
+    @property
+    def test_source(self) -> str:
+        return self.source_path or self.base_path
 
     def copy_at(self, copied_path: str):
-        """Duplicate the module test at a new path"""
+        """
+        Duplicate the module test at a new path
+        Large fixtures are cloned (reflinked) where the filesystem allows it, never shared with the source
+        """
         self.copied_path = copied_path
+        self.edits = []
+        self.edit_call = None
+        self.moves = []
+        self.test_digest = None
 
         if os.path.exists(self.copied_path):
             shutil.rmtree(self.copied_path)
-        shutil.copytree(self.base_path, self.copied_path)
+        clone_tree(self.test_source, self.copied_path)
 
     def add_setup_command(self, command: str) -> None:
         """
@@ -43,15 +78,69 @@ class BaseModuleTest:
             f.write("\n" + command + "\n")
         os.chmod(f"{self.copied_path}/env_setup.sh", 0o777)
 
+    def begin_edits(self, kind: str, original: str, replacement: str) -> None:
+        """Start a new replace call"""
+        self.edit_call = {
+            "kind": kind,
+            "original": original,
+            "replacement": replacement,
+            "seen": set() if self.edit_call is None else self.edit_call["seen"],
+        }
+
+    def original_path(self, filepath: str) -> str:
+        """The path a file of the copy had before the renames, relative to the copy"""
+        path = os.path.relpath(filepath, self.copied_path)
+        for new_path, old_path in reversed(self.moves):
+            if path == new_path or path.startswith(new_path + os.sep):
+                path = old_path + path[len(new_path) :]
+        return path
+
+    def keep_edit(self, filepath: str, location=()) -> bool:
+        """
+        Called before each edit of the current replace call, records it and returns whether to make it
+        An edit is identified by what it replaces, in which original file, and where in the file
+        (the positions of a YAML scalar, the number of a line), which do not depend on the other edits
+        being made: a replay keeping only some of them still means the same edits.
+        The replacement is left out, so a replay may shorten it.
+        """
+        edit_id = (
+            self.edit_call["kind"],
+            self.edit_call["original"],
+            self.original_path(filepath),
+            tuple(location),
+        )
+        ## The same text replaced twice at the same place, in two calls
+        while edit_id in self.edit_call["seen"]:
+            edit_id = edit_id + ("again",)
+        self.edit_call["seen"].add(edit_id)
+        if self.edit_filter is not None and edit_id not in self.edit_filter:
+            return False
+        self.edits.append(
+            {
+                "id": edit_id,
+                "kind": self.edit_call["kind"],
+                "original": self.edit_call["original"],
+                "replacement": self.edit_call["replacement"],
+                "file": os.path.relpath(filepath, self.copied_path),
+            }
+        )
+        return True
+
     def replace_in_code_with(self, original: str, replacement: str) -> None:
         if self.copied_path == None:
             raise Exception(f"Module {self.name} must be copied before transformations")
-        for currentpath, _, files in os.walk(f"{self.copied_path}/{self.extra_path}"):
-            for filename in files:
+        self.begin_edits("code", original, replacement)
+        for currentpath, folders, files in os.walk(
+            f"{self.copied_path}/{self.extra_path}"
+        ):
+            folders.sort()
+            for filename in sorted(files):
                 if filename.endswith(self.code_extension):
                     filepath = os.path.join(currentpath, filename)
                     with open(filepath) as f:
                         s = f.read()
+                    if original not in s or not self.keep_edit(filepath):
+                        continue
                     s = s.replace(original, replacement)
                     with open(filepath, "w") as f:
                         f.write(s)
@@ -61,16 +150,35 @@ class BaseModuleTest:
     ) -> None:
         if self.copied_path == None:
             raise Exception(f"Module {self.name} must be copied before transformations")
+        self.begin_edits("filename", original, replacement)
         for currentpath, folders, files in os.walk(
             f"{self.copied_path}/{self.extra_path}"
         ):
-            renamable = files if exclude_folders else folders + files
+            folders.sort()
+            renamable = sorted(files) if exclude_folders else folders + sorted(files)
             for filename in renamable:
                 filepath = os.path.join(currentpath, filename)
                 filename = os.path.basename(filepath)
+                if original not in filename or not self.keep_edit(filepath):
+                    continue
                 new_filename = filename.replace(original, replacement)
                 new_filepath = os.path.join(currentpath, new_filename)
                 os.rename(filepath, new_filepath)
+                self.moves.append(
+                    (
+                        os.path.relpath(new_filepath, self.copied_path),
+                        os.path.relpath(filepath, self.copied_path),
+                    )
+                )
+                self.renamed(filepath, new_filepath)
+
+    def renamed(self, filepath: str, new_filepath: str) -> None:
+        """Called after a file of the copied module was renamed"""
+        pass
+
+    def save(self) -> None:
+        """Write the transformations that are kept in memory to the copied module"""
+        pass
 
     def add_file(self, filepath: str) -> None:
         """Add a file to the module test's 'copied_path/files' folder"""
@@ -80,6 +188,8 @@ class BaseModuleTest:
             self.copied_path, "files", os.path.basename(filepath)
         )
         os.makedirs(os.path.dirname(new_filepath), exist_ok=True)
+        if os.path.exists(new_filepath):
+            os.remove(new_filepath)
         shutil.copyfile(filepath, new_filepath)
 
     def add_option_to_task(self, task_name, key, value) -> None:
@@ -103,10 +213,14 @@ class BaseModuleTest:
         """Important: make sure that there is a newline at both the beginning and end of the task"""
         raise NotImplementedError("add_after_task() must be implemented")
 
-    def exec_script_after_task(self, script: str, task_name: str) -> None:
-        """Add a task before the unit test"""
+    def exec_script_after_task(self, script: str, task_name: str, args="") -> None:
+        """Add a task before the unit test, running a script of 'copied_path/files' with args"""
         raise NotImplementedError("exec_script_after_task() must be implemented")
 
+    def exec_command_after_task(self, command: str, task_name: str) -> None:
+        """Add a task before the unit test, running a shell command on the target"""
+        raise NotImplementedError("exec_command_after_task() must be implemented")
+
     def duplicate_task(self, task_name: str) -> None:
         """Copy a task and paste it right after"""
         raise NotImplementedError("duplicate_task() must be implemented")
@@ -118,7 +232,9 @@ class BaseModuleTest:
 
 class AnsibleModuleTest(BaseModuleTest):
     """Integration tests for an Ansible module.
-    base_path points to the module's test role folder"""
+    base_path points to the module's test role folder
+    The YAML files of the copied role are loaded once into a RoleModel,
+    transformations edit it in memory and save() writes the modified files"""
 
     def __init__(self, name, base_path):
         super().__init__(
@@ -128,6 +244,31 @@ class AnsibleModuleTest(BaseModuleTest):
             extra_path="",
             creates_container=False,
         )
+        self.role_model = None
+
+    def copy_at(self, copied_path: str):
+        super().copy_at(copied_path)
+        self.role_model = None
+
+    @property
+    def role(self) -> RoleModel:
+        if self.copied_path == None:
+            raise Exception(f"Module {self.name} must be copied before transformations")
+        if self.role_model is None:
+            self.role_model = RoleModel(self.copied_path, self.code_extension)
+        return self.role_model
+
+    def replace_in_code_with(self, original: str, replacement: str) -> None:
+        self.begin_edits("code", original, replacement)
+        self.role.replace(original, replacement, self.keep_edit)
+
+    def renamed(self, filepath: str, new_filepath: str) -> None:
+        if self.role_model is not None:
+            self.role_model.rename(filepath, new_filepath)
+
+    def save(self) -> None:
+        if self.role_model is not None:
+            self.role_model.save()
 
     def add_option_to_task(self, task_name, key, value) -> None:
         option = f"""
@@ -147,149 +288,41 @@ class AnsibleModuleTest(BaseModuleTest):
         self.add_option_to_task(task_name, "check_mode", "yes")
 
     def get_values_of_options(self, keys) -> list:
-        values = []
-        for currentpath, _, files in os.walk(self.copied_path):
-            for filename in files:
-                if filename.endswith(self.code_extension):
-                    filepath = os.path.join(currentpath, filename)
-                    inside_task = False
-                    task_indentation = 0
-                    for line in fileinput.input(filepath, inplace=True):
-                        if not line.lstrip().startswith("#") and line != "\n":
-                            if not inside_task:
-                                if line.lstrip().startswith(f"{self.name}:"):
-                                    inside_task = True
-                                    task_indentation = len(line) - len(line.lstrip())
-                            else:
-                                if len(line) - len(line.lstrip()) <= task_indentation:
-                                    if line.lstrip().startswith(f"{self.name}:"):
-                                        task_indentation = len(line) - len(
-                                            line.lstrip()
-                                        )
-                                    else:
-                                        inside_task = False
-                                else:
-                                    for k in keys:
-                                        if line.lstrip().startswith(f"{k}:"):
-                                            values.append(
-                                                line.lstrip()
-                                                .lstrip(f"{k}:")
-                                                .lstrip()
-                                                .rstrip("\n")
-                                                .lstrip('"')
-                                                .lstrip("'")
-                                                .rstrip('"')
-                                                .rstrip("'")
-                                            )
-                                        break
-
-                        print(line, end="")
-        values = list(set(values))
-        for currentpath, _, files in os.walk(self.copied_path):
-            for filename in files:
-                if filename.endswith(self.code_extension):
-                    filepath = os.path.join(currentpath, filename)
-                    with open(filepath) as f:
-                        s = f.read()
-                        # Remove value from values if it appears as a key in the file
-                        for v in values:
-                            if v + ":" in s:
-                                values.remove(v)
-        return values
+        return self.role.values_of_options(self.name, keys)
 
     def add_after_task(self, task: str, existing_task_name: str) -> None:
+        """
+        task is a YAML snippet: a list of tasks is inserted after every call to the module,
+        a mapping is merged into those calls as options
+        """
+        snippet = YAML().load(task)
+        if isinstance(snippet, list):
+            self.role.insert_after_module_tasks(existing_task_name, snippet)
+        elif isinstance(snippet, dict):
+            for key, value in snippet.items():
+                self.role.set_option_of_module_tasks(existing_task_name, key, value)
+
+    def exec_script_after_task(self, script: str, task_name: str, args="") -> None:
         if self.copied_path == None:
             raise Exception(f"Module {self.name} must be copied before transformations")
-        for currentpath, _, files in os.walk(self.copied_path):
-            for filename in files:
-                if filename.endswith(self.code_extension):
-                    filepath = os.path.join(currentpath, filename)
+        task = f"""
+- name: Create snapshot
+  script: {f"{script} {args}".strip()}
+"""
+        self.add_after_task(task=task, existing_task_name=task_name)
 
-                    inside_name = False
-                    name_indentation = 0
-                    task_in_name = False
-                    for line in fileinput.input(filepath, inplace=True):
-                        if not line.lstrip().startswith("#") and line != "\n":
-                            if not inside_name:
-                                if line.lstrip().startswith("- name: "):
-                                    inside_name = True
-                                    task_in_name = False
-                                    name_indentation = len(line) - len(line.lstrip())
-                            else:
-                                if len(line) - len(line.lstrip()) <= name_indentation:
-                                    if task_in_name:
-                                        print(
-                                            task.replace(
-                                                "\n",
-                                                "\n" + " " * name_indentation,
-                                            )
-                                            + "\n",
-                                            end="",
-                                        )
-                                    if line.lstrip().startswith("- name: "):
-                                        task_in_name = False
-                                        name_indentation = len(line) - len(
-                                            line.lstrip()
-                                        )
-                                    else:
-                                        inside_name = False
-                                elif line.lstrip() == f"{existing_task_name}:\n":
-                                    task_in_name = True
-
-                        print(line, end="")
-                    # File ends with the task
-                    if inside_name and task_in_name:
-                        with open(filepath, "a") as f:
-                            f.write(
-                                task.replace("\n", "\n" + " " * name_indentation) + "\n"
-                            )
-
-    def exec_script_after_task(self, script: str, task_name: str) -> None:
+    def exec_command_after_task(self, command: str, task_name: str) -> None:
         if self.copied_path == None:
             raise Exception(f"Module {self.name} must be copied before transformations")
+        # raw needs neither an upload nor a Python interpreter on the target
         task = f"""
 - name: Create snapshot
-  script: {script}
+  raw: {json.dumps(command)}
 """
         self.add_after_task(task=task, existing_task_name=task_name)
 
     def duplicate_task(self, task_name) -> None:
-        if self.copied_path == None:
-            raise Exception(f"Module {self.name} must be copied before transformations")
-        for currentpath, _, files in os.walk(self.copied_path):
-            for filename in files:
-                if filename.endswith(self.code_extension):
-                    filepath = os.path.join(currentpath, filename)
-
-                    entire_name = ""
-                    inside_name = False
-                    name_indentation = 0
-                    task_in_name = False
-                    for line in fileinput.input(filepath, inplace=True):
-                        if not line.lstrip().startswith("#") and line != "\n":
-                            if not inside_name:
-                                if line.lstrip().startswith("- name: "):
-                                    inside_name = True
-                                    name_indentation = len(line) - len(line.lstrip())
-                                    entire_name = line
-                            else:
-                                if len(line) - len(line.lstrip()) <= name_indentation:
-                                    if task_in_name:
-                                        print(entire_name, end="")
-                                    if line.lstrip().startswith("- name: "):
-                                        task_in_name = False
-                                        name_indentation = len(line) - len(
-                                            line.lstrip()
-                                        )
-                                        entire_name = ""
-                                elif line.lstrip() == f"{task_name}:\n":
-                                    task_in_name = True
-                                entire_name += line
-                        print(line, end="")
-                    # File ends with the task
-                    if inside_name:
-                        with open(filepath, "a") as f:
-                            f.write("\n" + entire_name)
+        self.role.duplicate_module_tasks(task_name)
 
     def get_exec_command(self) -> str:
         """Get the command to execute the module test on Docker"""
@@ -304,7 +337,9 @@ class AnsibleModuleTest(BaseModuleTest):
 
 class PuppetModuleTest(BaseModuleTest):
     """Integration tests for a Puppet module.
-    base_path points to the module's 'spec' folder"""
+    base_path points to the module's 'spec' folder
+    The specs are parsed once per module revision into a SpecIndex,
+    transformations patch the index of the copy and save() writes the modified files"""
 
     def __init__(self, name, base_path):
         super().__init__(
@@ -314,41 +349,53 @@ class PuppetModuleTest(BaseModuleTest):
             extra_path="spec",
             creates_container=True,
         )
+        self.spec_index = None
+        # Beaker nodeset of a pre-provisioned host, None to let beaker provision a new one
+        self.beaker_nodeset = None
+
+    def bundle_key(self) -> str:
+        """Gems are installed once per Gemfile.lock (or Gemfile, if the module has no lock file)"""
+        digest = hashlib.sha256()
+        for filename in ("Gemfile.lock", "Gemfile"):
+            filepath = os.path.join(self.base_path, filename)
+            if os.path.exists(filepath):
+                with open(filepath, "rb") as f:
+                    digest.update(f.read())
+                break
+        return digest.hexdigest()[:16]
+
+    def copy_at(self, copied_path: str):
+        super().copy_at(copied_path)
+        self.spec_index = SpecIndex.for_copy(
+            f"{self.test_source}/{self.extra_path}",
+            f"{self.copied_path}/{self.extra_path}",
+            self.code_extension,
+        )
+
+    @property
+    def spec(self) -> SpecIndex:
+        if self.copied_path == None:
+            raise Exception(f"Module {self.name} must be copied before transformations")
+        return self.spec_index
+
+    def replace_in_code_with(self, original: str, replacement: str) -> None:
+        self.begin_edits("code", original, replacement)
+        self.spec.replace(original, replacement, self.keep_edit)
+
+    def renamed(self, filepath: str, new_filepath: str) -> None:
+        if self.spec_index is not None:
+            self.spec_index.rename(filepath, new_filepath)
+
+    def save(self) -> None:
+        if self.spec_index is not None:
+            self.spec_index.save()
 
     def add_option_to_task(
         self, task_name: str, key: str, value: str, skip_snapshot=False
     ) -> None:
         # apply_manifest's signature is: apply_manifest(manifest, opts = {}, &block) ⇒ Object
         # Here, we want to add an option to the opts hash
-        if self.copied_path == None:
-            raise Exception(f"Module {self.name} must be copied before transformations")
-        """Add a task before the unit test"""
-        for currentpath, _, files in os.walk(f"{self.copied_path}/{self.extra_path}"):
-            for filename in files:
-                if filename.endswith(self.code_extension):
-                    filepath = os.path.join(currentpath, filename)
-
-                    for line in fileinput.input(filepath, inplace=True):
-                        # Not a comment, and the whole function call is on one line
-                        # Also, if the option is already set, bail
-                        if (
-                            "#" not in line
-                            and (
-                                "apply_manifest(" in line
-                                or "apply_manifest_on(" in line
-                            )
-                            and (")\n" in line)
-                            and (key not in line)
-                        ):  # unit task
-                            if skip_snapshot and "collect_state.py" in line:
-                                print(line, end="")
-                                continue
-                            print(
-                                line.replace(f")\n", f", {key}: {value})\n"),
-                                end="",
-                            )
-                        else:
-                            print(line, end="")
+        self.spec.add_option(key, value, skip_snapshot=skip_snapshot)
 
     def set_env_var(self, name: str, value: str) -> None:
         """Set an environment variable at the beginning of the tests"""
@@ -363,81 +410,20 @@ class PuppetModuleTest(BaseModuleTest):
 
     def get_values_of_options(self, options) -> list:
         """Get the values of an option"""
-        if self.copied_path == None:
-            raise Exception(f"Module {self.name} must be copied before transformations")
-        """Add a task after the unit test"""
-        values = []
-        for currentpath, _, files in os.walk(f"{self.copied_path}/{self.extra_path}"):
-            for filename in files:
-                if filename.endswith(self.code_extension):
-                    filepath = os.path.join(currentpath, filename)
-
-                    inside_task = False
-                    task_indentation = 0
-                    for line in fileinput.input(filepath, inplace=True):
-                        if "#" not in line and "collect_state.py" not in line:
-                            if not inside_task and line.lstrip().startswith(
-                                f"{self.name} {{"
-                            ):
-                                inside_task = True
-                                task_indentation = len(line) - len(line.lstrip())
-                            elif (
-                                inside_task
-                                and len(line) - len(line.lstrip()) <= task_indentation
-                            ):
-                                inside_task = False
-
-                            if inside_task or "apply_manifest" in line:
-                                for o in options:
-                                    values += re.findall(
-                                        f"{o} {{ ['\"](.*?)['\"]:", line
-                                    )
-                                    values += re.findall(
-                                        f"{o} =>[ ]*['\"](.*?)['\"]", line
-                                    )
-
-                        print(line, end="")
-        return values
+        return self.spec.values_of_options(self.name, options)
 
     def add_after_task(self, task: str, existing_task_name: str) -> None:
-        if self.copied_path == None:
-            raise Exception(f"Module {self.name} must be copied before transformations")
         """Add a task after the unit test"""
-        for currentpath, _, files in os.walk(f"{self.copied_path}/{self.extra_path}"):
-            for filename in files:
-                if filename.endswith(self.code_extension):
-                    filepath = os.path.join(currentpath, filename)
+        self.spec.add_after_call_sites(task)
 
-                    for line in fileinput.input(filepath, inplace=True):
-                        if (
-                            "#" not in line
-                            and (
-                                "apply_manifest(" in line
-                                or "apply_manifest_on(" in line
-                            )
-                            and (")\n" in line)
-                            and "collect_state.py" not in line
-                        ):  # unit task
-                            # Number of spaces before start of line
-                            task_indentation = len(line) - len(line.lstrip())
-                            # Add indentation since we're now in the 'do' block
-
-                            print(
-                                line
-                                + task.replace("\n", "\n" + " " * task_indentation)
-                                + "\n",
-                                end="",
-                            )
-                        else:
-                            print(line, end="")
-
-    def exec_script_after_task(self, script: str, task_name: str) -> None:
+    def exec_script_after_task(self, script: str, task_name: str, args="") -> None:
         if self.copied_path == None:
             raise Exception(f"Module {self.name} must be copied before transformations")
+        command = f"python3 /mnt/{script} {args}".strip()
+        # The script is uploaded by the first hook only, every hook after that is a single command
         task = f"""
-scp_to(hosts.first, \"/{self.base_path}/files/{script}\", \"/mnt/{script}\")
-apply_manifest(\"exec {{ 'Making {script} executable': command => '/usr/bin/chmod +x /mnt/{script}' }}\")
-apply_manifest(\"exec {{ 'Running {script}': command => '/mnt/{script}' }}\")
+($thefuzz_uploaded ||= {{}})[\"{script}\"] ||= scp_to(hosts.first, \"/{self.base_path}/files/{script}\", \"/mnt/{script}\")
+on(hosts.first, \"{command}\")
 """
         self.add_after_task(task, task_name)
 
@@ -447,35 +433,20 @@ apply_manifest(\"exec {{ 'Running {script}': command => '/mnt/{script}' }}\")
         and duplicate all apply_manifest() calls. Most of those will be our tested module,
         but in any case, puppet manifests should always be idempotent.
         """
-        if self.copied_path == None:
-            raise Exception(f"Module {self.name} must be copied before transformations")
-        for currentpath, _, files in os.walk(self.copied_path):
-            for filename in files:
-                if filename.endswith(self.code_extension):
-                    filepath = os.path.join(currentpath, filename)
-                    for line in fileinput.input(filepath, inplace=True):
-                        if (
-                            "#" not in line
-                            and (
-                                "apply_manifest(" in line
-                                or "apply_manifest_on(" in line
-                            )
-                            and (")\n" in line)
-                            and (
-                                "collect_state.py" not in line
-                            )  # Make sure we're not duplicating any snapshots
-                        ):  # unit task
-                            print(line, end="")
-                        print(line, end="")
+        self.spec.duplicate_call_sites()
 
-    def get_exec_command(self) -> str:
+    def get_exec_command(self, spec="spec/acceptance") -> str:
         """Get the command to execute the module test"""
         test_command = 'bash -c "'
         # If setup_env.sh exists, source it
         if os.path.exists(f"{self.copied_path}/env_setup.sh"):
             test_command += f"source /{self.base_path}/env_setup.sh && "
         test_command += f"cd /{self.base_path}"
-        test_command += " && PDK_DISABLE_ANALYTICS=true pdk bundle install"
-        test_command += ' && BEAKER_destroy=no BEAKER_setfile=ubuntu2204-64 DOCKER_IN_DOCKER=true pdk bundle exec rspec spec/acceptance"'
+        # The gems live in the host's bundle volume, and are only installed when the lock file changes
+        test_command += f" && export BUNDLE_PATH=/bundle/{self.bundle_key()}"
+        test_command += " && export PDK_DISABLE_ANALYTICS=true"
+        test_command += " && (pdk bundle check || pdk bundle install)"
+        setfile = self.beaker_nodeset or "ubuntu2204-64"
+        test_command += f' && BEAKER_destroy=no BEAKER_setfile={setfile} DOCKER_IN_DOCKER=true pdk bundle exec rspec {spec}"'
 
         return test_command
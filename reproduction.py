@@ -0,0 +1,90 @@
+import hashlib
+import os
+import shutil
+import subprocess
+import tempfile
+
+import docker
+
+from fingerprint import TreeFingerprinter
+from module import BaseModuleTest
+
+## Label of the derived images, holding the key they were built from
+REPRODUCE_LABEL = "thefuzz.reproduce.key"
+
+
+def file_digest(path: str) -> str:
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def build_host_image(
+    client, name: str, image_script: str, base_image="testing:host"
+) -> str:
+    """
+    Derive testing:host-repro-<name> from the host image, running image_script once at build time
+    The image is rebuilt only when the script or the base image changed
+    """
+    key = hashlib.sha256(
+        (client.images.get(base_image).id + file_digest(image_script)).encode()
+    ).hexdigest()
+    repository = base_image.split(":")[0]
+    tag = f"{repository}:host-repro-{name}"
+    try:
+        if client.images.get(tag).labels.get(REPRODUCE_LABEL) == key:
+            return tag
+    except docker.errors.ImageNotFound:
+        pass
+
+    print(f"Building {tag}")
+    with tempfile.TemporaryDirectory() as context:
+        shutil.copy(image_script, os.path.join(context, "reproduce.sh"))
+        with open(os.path.join(context, "Dockerfile"), "w") as f:
+            f.write(
+                f"FROM {base_image}\n"
+                "COPY reproduce.sh /tmp/reproduce.sh\n"
+                "RUN bash /tmp/reproduce.sh && rm /tmp/reproduce.sh\n"
+            )
+        client.images.build(
+            path=context, tag=tag, labels={REPRODUCE_LABEL: key}, rm=True
+        )
+    return tag
+
+
+def prepare_test(module: BaseModuleTest, name: str, test_script: str, root: str) -> str:
+    """
+    Copy the module's test and run test_script on the copy, once per version of both
+    Returns the path of the copy, which the trials then copy their test from
+    """
+    key = hashlib.sha256(
+        (
+            TreeFingerprinter().tree_digest(module.base_path) + file_digest(test_script)
+        ).encode()
+    ).hexdigest()
+    path = os.path.join(root, f"{name}-{key[:12]}")
+    if os.path.exists(path):
+        return path
+
+    # Patch a staging copy, so a failed patch never leaves a half patched test behind
+    staging = f"{path}.{os.getpid()}.tmp"
+    if os.path.exists(staging):
+        shutil.rmtree(staging)
+    shutil.copytree(module.base_path, staging, symlinks=True)
+    subprocess.run(["bash", test_script, staging], check=True)
+    os.makedirs(root, exist_ok=True)
+    os.rename(staging, path)
+    return path
+
+
+def prepare_reproduction(
+    client, module: BaseModuleTest, reproduce: dict, root: str
+) -> None:
+    """
+    Set up a reproduction scenario of the config for a module:
+    its trials run on a derived host image, and/or start from a patched copy of its test
+    """
+    name = reproduce.get("name", module.name)
+    if reproduce.get("image_script"):
+        module.host_image = build_host_image(client, name, reproduce["image_script"])
+    if reproduce.get("test_script"):
+        module.source_path = prepare_test(module, name, reproduce["test_script"], root)
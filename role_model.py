@@ -0,0 +1,247 @@
+import copy
+import io
+import os
+
+from ruamel.yaml import YAML
+from ruamel.yaml.error import YAMLError
+from ruamel.yaml.util import load_yaml_guess_indent
+
+## Keys under which a task or a play holds a nested list of tasks
+NESTED_TASK_KEYS = (
+    "block",
+    "rescue",
+    "always",
+    "tasks",
+    "pre_tasks",
+    "post_tasks",
+    "handlers",
+)
+
+
+class RoleFile:
+    """A YAML file of a role, parsed once and dumped again only if it was modified"""
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        with open(path, encoding="utf-8") as f:
+            self.text = f.read()
+        self.dirty = False
+        self.indent = 2
+        self.block_seq_indent = 0
+        yaml = YAML()
+        yaml.preserve_quotes = True
+        try:
+            self.data, indent, block_seq_indent = load_yaml_guess_indent(
+                self.text, yaml=yaml
+            )
+            self.indent = indent or 2
+            self.block_seq_indent = block_seq_indent or 0
+        except YAMLError:
+            # Multiple documents, or Jinja that is not valid YAML: only plain text replacements apply
+            self.data = None
+
+    def dump(self) -> str:
+        if self.data is None:
+            return self.text
+        yaml = YAML()
+        yaml.preserve_quotes = True
+        yaml.width = 4096
+        yaml.explicit_start = self.text.lstrip().startswith("---")
+        yaml.indent(
+            mapping=max(self.indent - self.block_seq_indent, 2),
+            sequence=max(self.indent, self.block_seq_indent + 2),
+            offset=self.block_seq_indent,
+        )
+        stream = io.StringIO()
+        yaml.dump(self.data, stream)
+        return stream.getvalue()
+
+    def save(self) -> None:
+        if not self.dirty:
+            return
+        self.text = self.dump()
+        with open(self.path, "w", encoding="utf-8") as f:
+            f.write(self.text)
+        self.dirty = False
+
+
+def is_module_task(task, module_name: str) -> bool:
+    """Whether a task calls the given module, either by its short name or by its FQCN"""
+    if not isinstance(task, dict):
+        return False
+    return any(
+        isinstance(key, str) and (key == module_name or key.endswith("." + module_name))
+        for key in task
+    )
+
+
+def module_args(task, module_name: str):
+    for key, value in task.items():
+        if isinstance(key, str) and (
+            key == module_name or key.endswith("." + module_name)
+        ):
+            return value
+    return None
+
+
+def append_key(task, key, value) -> None:
+    """Add a key at the end of a task, keeping the blank lines and comments that follow the task after it"""
+    if key in task:
+        task[key] = value
+        return
+    last_key = list(task.keys())[-1] if len(task) > 0 else None
+    task[key] = value
+    if last_key is not None and last_key in task.ca.items:
+        task.ca.items[key] = task.ca.items.pop(last_key)
+
+
+def replace_in_node(node, original: str, replacement: str, keep=None, location=()):
+    """
+    Replace a substring in every string key and scalar of a YAML tree, in place
+    keep(location), if given, is asked before each scalar is edited, and may leave it as it is.
+    The location of a scalar is the positions leading to it, which edits do not change, "key" for a key.
+    Returns the new node (scalars are immutable) and whether anything changed
+    """
+    if isinstance(node, str):
+        if original not in node or (keep is not None and not keep(location)):
+            return node, False
+        # Keep the scalar's type, so quoting styles survive the round-trip
+        return type(node)(node.replace(original, replacement)), True
+    changed = False
+    if isinstance(node, dict):
+        for position, key in enumerate(list(node.keys())):
+            value, value_changed = replace_in_node(
+                node[key], original, replacement, keep, location + (position,)
+            )
+            new_key, key_changed = replace_in_node(
+                key, original, replacement, keep, location + (position, "key")
+            )
+            if key_changed:
+                node.pop(key)
+                node.insert(position, new_key, value)
+            elif value_changed:
+                node[key] = value
+            changed = changed or key_changed or value_changed
+    elif isinstance(node, list):
+        for position, item in enumerate(node):
+            item, item_changed = replace_in_node(
+                item, original, replacement, keep, location + (position,)
+            )
+            if item_changed:
+                node[position] = item
+                changed = True
+    return node, changed
+
+
+class RoleModel:
+    """
+    All YAML files of a copied role, loaded once.
+    Transformations are applied to the trees in memory, and save() writes each modified file once.
+    """
+
+    def __init__(self, root: str, extension: str) -> None:
+        self.root = root
+        self.files = {}
+        # Sorted, so that transformations visit the files in the same order on every run
+        for currentpath, folders, files in os.walk(root):
+            folders.sort()
+            for filename in sorted(files):
+                if filename.endswith(extension):
+                    filepath = os.path.join(currentpath, filename)
+                    self.files[filepath] = RoleFile(filepath)
+
+    def task_lists(self):
+        """Yields (role file, list of tasks) for every task list, including nested blocks"""
+        for role_file in self.files.values():
+            if isinstance(role_file.data, list):
+                stack = [role_file.data]
+                while stack:
+                    tasks = stack.pop()
+                    yield role_file, tasks
+                    for task in tasks:
+                        if isinstance(task, dict):
+                            for key in NESTED_TASK_KEYS:
+                                if isinstance(task.get(key), list):
+                                    stack.append(task[key])
+
+    def module_tasks(self, module_name: str):
+        for _, tasks in self.task_lists():
+            for task in tasks:
+                if is_module_task(task, module_name):
+                    yield task
+
+    def values_of_options(self, module_name: str, keys) -> list:
+        # First seen order, a trial replayed from its seed must draw its random values for the same options
+        values = {}
+        for task in self.module_tasks(module_name):
+            args = module_args(task, module_name)
+            if isinstance(args, dict):
+                for k in keys:
+                    if k in args and args[k] is not None:
+                        values[str(args[k])] = None
+        # Remove values that appear as a key in the role
+        return [
+            v
+            for v in values
+            if not any(v + ":" in role_file.text for role_file in self.files.values())
+        ]
+
+    def duplicate_module_tasks(self, module_name: str) -> None:
+        for role_file, tasks in list(self.task_lists()):
+            position = 0
+            while position < len(tasks):
+                if is_module_task(tasks[position], module_name):
+                    tasks.insert(position + 1, copy.deepcopy(tasks[position]))
+                    position += 1
+                    role_file.dirty = True
+                position += 1
+
+    def insert_after_module_tasks(self, module_name: str, new_tasks: list) -> None:
+        for role_file, tasks in list(self.task_lists()):
+            position = 0
+            while position < len(tasks):
+                if is_module_task(tasks[position], module_name):
+                    for offset, new_task in enumerate(new_tasks):
+                        tasks.insert(position + 1 + offset, copy.deepcopy(new_task))
+                    position += len(new_tasks)
+                    role_file.dirty = True
+                position += 1
+
+    def set_option_of_module_tasks(self, module_name: str, key: str, value) -> None:
+        for role_file, tasks in self.task_lists():
+            for task in tasks:
+                if is_module_task(task, module_name):
+                    append_key(task, key, value)
+                    role_file.dirty = True
+
+    def replace(self, original: str, replacement: str, keep=None) -> None:
+        """keep(filepath, location), if given, is asked before each scalar (or text file) is edited"""
+        for role_file in self.files.values():
+            if role_file.data is None:
+                if original in role_file.text and (
+                    keep is None or keep(role_file.path)
+                ):
+                    role_file.text = role_file.text.replace(original, replacement)
+                    role_file.dirty = True
+            else:
+                role_file.data, changed = replace_in_node(
+                    role_file.data,
+                    original,
+                    replacement,
+                    None
+                    if keep is None
+                    else lambda location: keep(role_file.path, location),
+                )
+                role_file.dirty = role_file.dirty or changed
+
+    def rename(self, old_path: str, new_path: str) -> None:
+        """Follow a file or folder that was renamed on disk"""
+        for filepath in list(self.files):
+            if filepath == old_path or filepath.startswith(old_path + os.sep):
+                role_file = self.files.pop(filepath)
+                role_file.path = new_path + filepath[len(old_path) :]
+                self.files[role_file.path] = role_file
+
+    def save(self) -> None:
+        for role_file in self.files.values():
+            role_file.save()
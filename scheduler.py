@@ -0,0 +1,125 @@
+import math
+import random
+import threading
+import time
+
+
+class Arm:
+    """A (module, transformation) combination the scheduler can spend trials on"""
+
+    def __init__(self, module, transformation) -> None:
+        self.module = module
+        self.transformation = transformation
+        self.pulls = 0
+        self.rewards = 0
+        self.results = 0
+        ## Trials in a row that only found an already known finding
+        self.duplicates = 0
+
+    @property
+    def mean(self) -> float:
+        return self.rewards / self.results if self.results > 0 else 0.0
+
+
+class BaseScheduler:
+    """
+    Decides which transformation of which module the next trial runs.
+    A campaign stops when the arms are exhausted or when the trial or wall-clock budget is spent.
+    An arm is retired after max_duplicates trials in a row that only found known findings.
+    """
+
+    def __init__(
+        self, module_trans: dict, max_trials=None, time_budget=None, max_duplicates=None
+    ) -> None:
+        self.arms = [
+            Arm(module, transformation)
+            for module, transformations in module_trans.items()
+            for transformation in transformations
+        ]
+        self.max_trials = max_trials
+        self.time_budget = time_budget
+        self.max_duplicates = max_duplicates
+        self.started = time.time()
+        self.trials = 0
+        self.lock = threading.Lock()
+
+    def budget_spent(self) -> bool:
+        if self.max_trials is not None and self.trials >= self.max_trials:
+            return True
+        if (
+            self.time_budget is not None
+            and time.time() - self.started >= self.time_budget
+        ):
+            return True
+        return False
+
+    def select(self) -> Arm:
+        raise NotImplementedError("select() must be implemented")
+
+    def next(self):
+        """Returns the (module, transformation) of the next trial, or None when the campaign is over"""
+        with self.lock:
+            if len(self.arms) == 0 or self.budget_spent():
+                return None
+            arm = self.select()
+            arm.pulls += 1
+            self.trials += 1
+            # Transformations that are not repeated only get a single trial
+            if not arm.transformation.repeat:
+                self.arms.remove(arm)
+            return arm
+
+    def update(self, arm: Arm, novelty: int, outcome=None) -> None:
+        """
+        Report the number of new distinct state differences a trial found, and its outcome
+        The reward is whether it found any, UCB1 needs rewards in [0, 1]
+        """
+        with self.lock:
+            arm.results += 1
+            arm.rewards += 1 if novelty > 0 else 0
+            arm.duplicates = arm.duplicates + 1 if outcome == "duplicate" else 0
+            if (
+                self.max_duplicates is not None
+                and arm.duplicates >= self.max_duplicates
+                and arm in self.arms
+            ):
+                print(
+                    f"Retiring {arm.transformation.name} of {arm.module.name}: {arm.duplicates} known findings in a row"
+                )
+                self.arms.remove(arm)
+
+
+class RandomScheduler(BaseScheduler):
+    """Pick a random module, then one of its transformations at random"""
+
+    def select(self) -> Arm:
+        module = random.choice(list({arm.module: None for arm in self.arms}))
+        return random.choice([arm for arm in self.arms if arm.module == module])
+
+
+class BanditScheduler(BaseScheduler):
+    """
+    UCB1: every arm is tried once, then trials go to the arm with the best rate of novel trials
+    plus an exploration bonus that shrinks as the arm gets more trials
+    """
+
+    def __init__(self, module_trans: dict, exploration=1.0, **kwargs) -> None:
+        super().__init__(module_trans, **kwargs)
+        self.exploration = exploration
+
+    def select(self) -> Arm:
+        untried = [arm for arm in self.arms if arm.pulls == 0]
+        if len(untried) > 0:
+            return random.choice(untried)
+        total = sum(arm.pulls for arm in self.arms)
+        return max(
+            self.arms,
+            key=lambda arm: arm.mean
+            + self.exploration * math.sqrt(2 * math.log(total) / arm.pulls),
+        )
+
+
+SCHEDULERS = {
+    "random": RandomScheduler,
+    "bandit": BanditScheduler,
+}
@@ -0,0 +1,213 @@
+import functools
+import os
+import re
+import threading
+
+SNAPSHOT_MARKER = "collect_state.py"
+
+## Pristine indexes, keyed on the module's spec folder and its revision
+_INDEX_CACHE = {}
+_INDEX_CACHE_LOCK = threading.Lock()
+
+
+@functools.lru_cache(maxsize=None)
+def option_patterns(option: str) -> tuple:
+    return (
+        re.compile(f"{option} {{ ['\"](.*?)['\"]:"),
+        re.compile(f"{option} =>[ ]*['\"](.*?)['\"]"),
+    )
+
+
+def is_candidate(line: str) -> bool:
+    return "apply_manifest" in line or SNAPSHOT_MARKER in line
+
+
+def is_call_site(line: str) -> bool:
+    """
+    Not a comment, and the whole apply_manifest() call is on one line
+    The on() calls of the snapshot hooks count as well, so they get the same options (e.g. environment)
+    """
+    return (
+        "#" not in line
+        and (
+            "apply_manifest(" in line
+            or "apply_manifest_on(" in line
+            or (SNAPSHOT_MARKER in line and line.lstrip().startswith("on("))
+        )
+        and ")\n" in line
+    )
+
+
+def indentation(line: str) -> int:
+    return len(line) - len(line.lstrip())
+
+
+class SpecFile:
+    """The lines of an acceptance spec, with the positions of the lines that mention apply_manifest or a snapshot"""
+
+    def __init__(self, path: str, lines: list) -> None:
+        self.path = path
+        self.lines = lines
+        self.candidates = [i for i, line in enumerate(lines) if is_candidate(line)]
+        self.dirty = False
+
+    def copy(self, path: str):
+        spec_file = SpecFile.__new__(SpecFile)
+        spec_file.path = path
+        spec_file.lines = list(self.lines)
+        spec_file.candidates = list(self.candidates)
+        spec_file.dirty = False
+        return spec_file
+
+    def call_sites(self, include_snapshots=False) -> list:
+        return [
+            i
+            for i in self.candidates
+            if is_call_site(self.lines[i])
+            and (include_snapshots or SNAPSHOT_MARKER not in self.lines[i])
+        ]
+
+    def insert_lines(self, insertions: dict) -> None:
+        """Insert lists of lines after the given positions, keeping the candidates up to date"""
+        lines = []
+        candidates = []
+        for i, line in enumerate(self.lines):
+            for new_line in [line] + insertions.get(i, []):
+                if is_candidate(new_line):
+                    candidates.append(len(lines))
+                lines.append(new_line)
+        self.lines = lines
+        self.candidates = candidates
+        self.dirty = self.dirty or len(insertions) > 0
+
+    def save(self) -> None:
+        if not self.dirty:
+            return
+        with open(self.path, "w") as f:
+            f.writelines(self.lines)
+        self.dirty = False
+
+
+class SpecIndex:
+    """
+    The acceptance specs of a Puppet module, parsed once per module revision.
+    Transformations query and patch the index of their copy, and save() writes the modified files.
+    """
+
+    def __init__(self, root: str, files: dict) -> None:
+        self.root = root
+        self.files = files
+
+    @staticmethod
+    def revision(root: str, extension: str) -> tuple:
+        """Cheap fingerprint of the spec files, only their names, sizes and modification times"""
+        revision = []
+        for currentpath, _, files in os.walk(root):
+            for filename in files:
+                if filename.endswith(extension):
+                    stat = os.stat(os.path.join(currentpath, filename))
+                    revision.append(
+                        (
+                            os.path.relpath(os.path.join(currentpath, filename), root),
+                            stat.st_size,
+                            stat.st_mtime_ns,
+                        )
+                    )
+        return tuple(sorted(revision))
+
+    @classmethod
+    def parse(cls, root: str, extension: str):
+        files = {}
+        # Sorted, so that transformations visit the files in the same order on every run
+        for currentpath, folders, filenames in os.walk(root):
+            folders.sort()
+            for filename in sorted(filenames):
+                if filename.endswith(extension):
+                    filepath = os.path.join(currentpath, filename)
+                    with open(filepath) as f:
+                        files[filepath] = SpecFile(filepath, f.readlines())
+        return cls(root, files)
+
+    @classmethod
+    def for_copy(cls, original_root: str, copied_root: str, extension: str):
+        """Index of a copy of the spec folder, parsing the original only when it changed"""
+        key = (os.path.abspath(original_root), cls.revision(original_root, extension))
+        with _INDEX_CACHE_LOCK:
+            if key not in _INDEX_CACHE:
+                _INDEX_CACHE[key] = cls.parse(original_root, extension)
+            pristine = _INDEX_CACHE[key]
+        files = {}
+        for filepath, spec_file in pristine.files.items():
+            copied_filepath = os.path.join(
+                copied_root, os.path.relpath(filepath, original_root)
+            )
+            files[copied_filepath] = spec_file.copy(copied_filepath)
+        return cls(copied_root, files)
+
+    def add_option(self, key: str, value: str, skip_snapshot=False) -> None:
+        for spec_file in self.files.values():
+            for i in spec_file.call_sites(include_snapshots=True):
+                line = spec_file.lines[i]
+                # If the option is already set, bail
+                if key in line or (skip_snapshot and SNAPSHOT_MARKER in line):
+                    continue
+                spec_file.lines[i] = line.replace(f")\n", f", {key}: {value})\n")
+                spec_file.dirty = True
+
+    def values_of_options(self, resource: str, options) -> list:
+        values = []
+        patterns = [pattern for o in options for pattern in option_patterns(o)]
+        for spec_file in self.files.values():
+            inside_task = False
+            task_indentation = 0
+            for line in spec_file.lines:
+                if "#" in line or SNAPSHOT_MARKER in line:
+                    continue
+                if not inside_task and line.lstrip().startswith(f"{resource} {{"):
+                    inside_task = True
+                    task_indentation = indentation(line)
+                elif inside_task and indentation(line) <= task_indentation:
+                    inside_task = False
+
+                if inside_task or "apply_manifest" in line:
+                    for pattern in patterns:
+                        values += pattern.findall(line)
+        return values
+
+    def add_after_call_sites(self, task: str) -> None:
+        for spec_file in self.files.values():
+            insertions = {}
+            for i in spec_file.call_sites():
+                # Add indentation since we're now in the 'do' block
+                text = (
+                    task.replace("\n", "\n" + " " * indentation(spec_file.lines[i]))
+                    + "\n"
+                )
+                insertions[i] = text.splitlines(keepends=True)
+            spec_file.insert_lines(insertions)
+
+    def duplicate_call_sites(self) -> None:
+        for spec_file in self.files.values():
+            spec_file.insert_lines(
+                {i: [spec_file.lines[i]] for i in spec_file.call_sites()}
+            )
+
+    def replace(self, original: str, replacement: str, keep=None) -> None:
+        """keep(filepath, location), if given, is asked before each line is edited, its location is the line number"""
+        for spec_file in self.files.values():
+            for i, line in enumerate(spec_file.lines):
+                if original in line and (keep is None or keep(spec_file.path, (i,))):
+                    spec_file.lines[i] = line.replace(original, replacement)
+                    spec_file.dirty = True
+
+    def rename(self, old_path: str, new_path: str) -> None:
+        """Follow a file or folder that was renamed on disk"""
+        for filepath in list(self.files):
+            if filepath == old_path or filepath.startswith(old_path + os.sep):
+                spec_file = self.files.pop(filepath)
+                spec_file.path = new_path + filepath[len(old_path) :]
+                self.files[spec_file.path] = spec_file
+
+    def save(self) -> None:
+        for spec_file in self.files.values():
+            spec_file.save()
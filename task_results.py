@@ -0,0 +1,83 @@
+import json
+import os
+
+
+class TaskResults:
+    """
+    The task results written by the thefuzz_results callback plugin during an Ansible run
+    A run without a recap line did not finish, and counts as a crash
+    Like Ansible's recap, failures a block's rescue recovered from do not count
+    """
+
+    def __init__(self, results: list, stats: list) -> None:
+        self.results = results
+        self.stats = stats
+
+    @classmethod
+    def load(cls, path: str):
+        """Returns None if the plugin did not write anything, e.g. for Puppet modules"""
+        if not os.path.exists(path):
+            return None
+        results = []
+        stats = []
+        with open(path) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # The run was stopped while a line was being written
+                    continue
+                if entry.get("event") == "stats":
+                    stats.append(entry)
+                else:
+                    results.append(entry)
+        return cls(results, stats)
+
+    @property
+    def finished(self) -> bool:
+        return len(self.stats) > 0
+
+    def failing_hosts(self) -> set:
+        """Hosts the recap reports failures or unreachable tasks for, rescued failures are not counted there"""
+        return {
+            entry["host"]
+            for entry in self.stats
+            if entry.get("failures", 0) > 0 or entry.get("unreachable", 0) > 0
+        }
+
+    def failed_tasks(self) -> list:
+        """
+        Results that failed the run, ignored errors excluded
+        A host stops at the failure that was not rescued, so once the recap is written,
+        that is the last failure of each failing host. Before, every failure counts.
+        """
+        failures = [
+            result
+            for result in self.results
+            if result["status"] in ("failed", "unreachable")
+            and not result["ignore_errors"]
+        ]
+        if not self.finished:
+            return failures
+        failing_hosts = self.failing_hosts()
+        last_failures = {}
+        for result in failures:
+            if result["host"] in failing_hosts:
+                last_failures[result["host"]] = result
+        return list(last_failures.values())
+
+    @property
+    def crashed(self) -> bool:
+        return not self.finished or len(self.failing_hosts()) > 0
+
+    def task_durations(self) -> dict:
+        """Total seconds spent in each task, summed over hosts and loops"""
+        durations = {}
+        for result in self.results:
+            if result.get("duration") is not None:
+                key = f"{result['position']}: {result['task']}"
+                durations[key] = round(durations.get(key, 0) + result["duration"], 3)
+        return durations
+
+    def slowest_tasks(self, count=5) -> list:
+        return sorted(self.task_durations().items(), key=lambda item: -item[1])[:count]
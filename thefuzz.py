@@ -4,14 +4,41 @@ import shutil, os
 import tarfile
 import yaml
 import docker
-import pickle
 import pathlib
 import emoji
+import bisect
+import copy
+import difflib
+import hashlib
+import io
+import json
+import queue
+import threading
+import time
 from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
 
 from module import *
 from transformations import *
-from collect_state import State
+from collect_state import SNAPSHOT_LOG_NAME, SnapshotLog, State
+from workspace import Workspace, create_workspaces
+from baseline_cache import BaselineCache
+from fingerprint import TreeFingerprinter
+from scheduler import SCHEDULERS
+from container_pool import ContainerPool, remove_container
+from exec_stream import LogWatcher, stream_exec
+from task_results import TaskResults
+from beaker_image import provision_beaker_image, write_nodeset
+from reproduction import prepare_reproduction
+from ledger import Ledger
+from artifact_store import ArtifactStore
+from checkpoints import (
+    apply_resume_plan,
+    plan_resume,
+    remove_images,
+    run_with_checkpoints,
+    start_checkpoint_target,
+)
 
 
 MODULE_TYPE_TO_CLASS = {
@@ -29,40 +56,85 @@ TRANSFORMATION_NAME_TO_CLASS = {
     "dry_run": DryRunMode,
 }
 
-MODULE_UNDER_TEST = ""
-TRANSFORMATION_UNDER_TEST = ""
-MODULE_BASELINE = ""
-
-
-def apply_transformation(module, transformation):
+## Baseline states of each module, indexed by module name
+MODULE_BASELINES = {}
+## Seconds a test run may take, and may stay silent, before it is abandoned
+TRIAL_TIMEOUT = None
+IDLE_TIMEOUT = None
+## Target images committed at each snapshot of the baselines, indexed by module name
+MODULE_CHECKPOINTS = {}
+CHECKPOINTS_ENABLED = False
+## Command line arguments of collect_state.py in the snapshot tasks
+SNAPSHOT_ARGS = ""
+## Ansible snapshots are taken by a collector agent running on the target
+SNAPSHOT_AGENT = True
+## Puppet trials start beaker's host from an image provisioned once per module
+BEAKER_IMAGES = True
+## Number of transformed Ansible trials that share a single ansible-playbook run
+FAN_OUT = 1
+## Baselines of previous campaigns, None if caching is disabled
+BASELINE_CACHE = None
+## Digests of the transformed tests already run (or running) for each module, baseline included
+MODULE_FINGERPRINTS = defaultdict(set)
+FINGERPRINTS_LOCK = threading.Lock()
+FINGERPRINTER = TreeFingerprinter()
+## Distinct state difference signatures found so far for each module
+MODULE_SIGNATURES = defaultdict(set)
+## Number of times each finding signature was found, indexed by (module name, signature)
+FINDING_COUNTS = defaultdict(int)
+## Every trial of the campaign, and the numbering of its output directories
+LEDGER = None
+## Deduplicated content of the output directories
+ARTIFACTS = None
+## Beaker names its containers itself, so Puppet trials cannot be isolated from each other
+PUPPET_LOCK = threading.Lock()
+## Every container we start is labelled, so leftovers of a previous campaign can be found
+CONTAINER_LABEL = "thefuzz"
+
+
+def apply_transformation(module, transformation, workspace: Workspace, seed=None):
     """
-    copy the test directory to a local temporary dir and maybe make changes to it. This temp dir (./mnt/test) Will be mounted to the container at run time and these tests will be performed
+    copy the test directory to the trial's workspace and maybe make changes to it. This dir (<workspace>/host/mnt/test) Will be mounted to the container at run time and these tests will be performed
+    A trial is replayed by passing the seed it was recorded with
     """
-    host_directory = "host/mnt/test"
-    target_directory = "target/mnt/test"
+    host_directory = workspace.host_test
+    target_directory = workspace.target_test
 
     # Copy module somewhere where we can modify it
     module.copy_at(host_directory)
     shutil.copy("env_setup.sh", f"{module.copied_path}/env_setup.sh")
     # Prep for snapshots
-    CaptureSnapshot().transform(module)
+    CaptureSnapshot(args=snapshot_args(module), agent=SNAPSHOT_AGENT).transform(module)
 
-    # Apply the relevant transformation
+    # Apply the relevant transformation, with random choices of its own
+    transformation.reseed(seed)
     transformation.transform(module)
+    # Write the modified files, once
+    module.save()
 
-    # Also copy perturbed test to target
-    # TODO: Probs unnecessary, we only need the setup + snapshot scripts there
+    # The target only needs the setup and snapshot scripts, not the whole perturbed test
     if os.path.exists(target_directory):
         shutil.rmtree(target_directory)
-    shutil.copytree(host_directory, target_directory)
+    os.makedirs(target_directory)
+    for script in ("env_setup.sh", "files/collect_state.py"):
+        if os.path.exists(f"{host_directory}/{script}"):
+            shutil.copy(f"{host_directory}/{script}", target_directory)
 
     # Remove snapshot directory if it already exists
-    if os.path.exists("target/mnt/snapshots"):
-        shutil.rmtree("target/mnt/snapshots")
+    if os.path.exists(workspace.snapshots):
+        shutil.rmtree(workspace.snapshots)
 
     return
 
 
+def snapshot_args(module: BaseModuleTest):
+    """Command line arguments of collect_state.py for a module"""
+    args = SNAPSHOT_ARGS
+    if module.snapshot_roots:
+        args += " --roots " + " ".join(module.snapshot_roots)
+    return args
+
+
 def get_path_options(source_path: str):
     """
     Returns a list of all the options in the provided source file that are paths
@@ -90,13 +162,102 @@ def get_path_options(source_path: str):
     return path_options
 
 
-def create_config():
+def parse_args():
     parser = ArgumentParser()
     parser.add_argument("-m", "--module", nargs="*")
     parser.add_argument("-c", "--config", default="config.yaml")
     parser.add_argument("-n", "--new", action="store_true")
-    args = parser.parse_args()
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=1,
+        help="Number of trials to run concurrently, each in its own workspace",
+    )
+    parser.add_argument("--workspaces", default="workspaces")
+    parser.add_argument(
+        "--checkpoints",
+        action="store_true",
+        help="Commit the target at every baseline snapshot, and start trials from the last checkpoint before their first modified task",
+    )
+    parser.add_argument(
+        "--scheduler",
+        choices=sorted(SCHEDULERS.keys()),
+        default="random",
+        help="How the next module and transformation are picked",
+    )
+    parser.add_argument(
+        "--max-trials", type=int, help="Stop after this many transformed trials"
+    )
+    parser.add_argument(
+        "--time-budget",
+        type=float,
+        help="Stop scheduling trials after this many seconds",
+    )
+    parser.add_argument(
+        "--max-duplicates",
+        type=int,
+        help="Stop trying a transformation of a module after this many known findings in a row",
+    )
+    parser.add_argument(
+        "--hash-algorithm",
+        default="md5",
+        help="Algorithm the snapshots use to hash the files in /etc, e.g. blake2b",
+    )
+    parser.add_argument(
+        "--file-metadata",
+        action="store_true",
+        help="Snapshots record the mode, owner and size of every file, not only its name",
+    )
+    parser.add_argument("--cache-dir", default=".thefuzz_cache/baselines")
+    parser.add_argument(
+        "--reproduce-dir",
+        default=".thefuzz_cache/reproduce",
+        help="Where the patched tests of the reproduction scenarios are kept",
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="Always rerun the baselines instead of reusing the ones of previous campaigns",
+    )
+    parser.add_argument(
+        "--max-host-uses",
+        type=int,
+        default=50,
+        help="Number of trials a warm host container runs before it is replaced",
+    )
+    parser.add_argument(
+        "--timeout",
+        type=float,
+        default=3600,
+        help="Seconds a test run may take before the trial is recorded as a timeout",
+    )
+    parser.add_argument(
+        "--idle-timeout",
+        type=float,
+        default=900,
+        help="Seconds a test run may go without printing anything before the trial is recorded as a timeout",
+    )
+    parser.add_argument(
+        "--fan-out",
+        type=int,
+        default=1,
+        help="Number of transformed Ansible trials run together by a single ansible-playbook run, each on its own target",
+    )
+    parser.add_argument(
+        "--no-beaker-image",
+        action="store_true",
+        help="Let beaker provision a new host for every Puppet trial, instead of starting it from a provisioned image",
+    )
+    parser.add_argument(
+        "--no-snapshot-agent",
+        action="store_true",
+        help="Run collect_state.py from scratch for every Ansible snapshot, instead of asking an agent on the target",
+    )
+    return parser.parse_args()
+
 
+def create_config(args):
     config_file = args.config
     if not args.new and os.path.exists(config_file):
         print(f"Using the config file at '{config_file}'")
@@ -196,6 +357,10 @@ def transformations_per_module(config):
         module = MODULE_TYPE_TO_CLASS[module_data["type"]](
             name=module_data["name"], base_path=module_data["path"]
         )
+        # Limit the file tree of the snapshots to what the module can plausibly touch
+        module.snapshot_roots = module_data.get("snapshot_roots")
+        # Reproduction scenario, set up once before the campaign
+        module.reproduce = module_data.get("reproduce")
         mod_trans[module] = []
         # Start with baseline test without transformation
         # Add all general transformations
@@ -229,14 +394,14 @@ def transformations_per_module(config):
     return mod_trans
 
 
-def generate_playbook(module):
+def generate_playbook(module, workspace: Workspace):
     playbook = f"""
 ---
 - hosts: test_target
   roles:
     - role: '/{module.base_path}'
 """
-    with open("host/mnt/playbook.yml", "w") as playbook_file:
+    with open(workspace.playbook, "w") as playbook_file:
         playbook_file.write(playbook)
 
 
@@ -246,7 +411,7 @@ def create_empty_folder(foldername):
     os.makedirs(foldername)
 
 
-def run_role_in_docker(module: BaseModuleTest, transformation: BaseTransformation):
+def prepare_module(module: BaseModuleTest):
     # If module is rhsm_repository, copy our custom test to /modules
     if module.name == "rhsm_repository" and not os.path.exists(
         "modules/community/tests/integration/targets/rhsm_repository"
@@ -255,255 +420,1093 @@ def run_role_in_docker(module: BaseModuleTest, transformation: BaseTransformatio
             "rhsm_repository",
             "modules/community/tests/integration/targets/rhsm_repository",
         )
-    # Copies module to host/mnt/test and perturbs it
-    apply_transformation(module, transformation)
-    generate_playbook(module)
 
-    client = docker.from_env()
 
-    ## First make sure all images are gone:
+def remove_leftover_containers(client, beaker_only=False):
+    """
+    Kill the containers of previous campaigns, or only the ones beaker created
+    """
     for container in client.containers.list():
-        if (
-            "beaker" in container.attrs["Name"]
-            or "testing" in container.attrs["Config"]["Image"]
+        if "beaker" in container.attrs["Name"] or (
+            not beaker_only
+            and (
+                CONTAINER_LABEL in container.labels
+                or "testing" in container.attrs["Config"]["Image"]
+            )
         ):
             container.kill()
             container.remove()
 
-    ## Setup up the mounting for the tests. We mount a local directory to each of the containers to both provide and collect data for the experiments
-
-    env = {"REPRODUCE": os.getenv("REPRODUCE")}
-    if module.creates_container:  # Puppet setting
-        # Give the host container access to the docker socket
-        host_mount = [
-            docker.types.Mount("/mnt", f"{os.getcwd()}/host/mnt", type="bind"),
-            docker.types.Mount("/var/run/docker.sock", "/var/run/docker.sock", "bind"),
-        ]
-        ## Launch host container
-        host = client.containers.run(
-            "testing:host", mounts=host_mount, detach=True, environment=env
+
+def reserve_output_path(module: BaseModuleTest, transformation: BaseTransformation):
+    """
+    Allocate the next output path for a finding from the ledger and create it,
+    so concurrent trials never end up writing to the same directory
+    """
+    while True:
+        t_id = LEDGER.next_output_id(module.name, transformation.name)
+        output_path = f"output/{module.name}/{transformation.name}{t_id:09d}"
+        try:
+            os.makedirs(output_path)
+            return output_path
+        except FileExistsError:
+            # Left by a campaign whose ledger was deleted
+            continue
+
+
+def snapshot_digests(snapshot_dirs: list):
+    """The digests of every snapshot, from the first of the directories holding a snapshot log"""
+    for snapshot_dir in snapshot_dirs:
+        snapshot_log = os.path.join(snapshot_dir, SNAPSHOT_LOG_NAME)
+        if os.path.exists(snapshot_log):
+            states = SnapshotLog(snapshot_log)
+            return [states.digests(state_id) for state_id in range(len(states))]
+    return None
+
+
+def record_trial(
+    module: BaseModuleTest,
+    transformation: BaseTransformation,
+    outcome: str,
+    output_path,
+    started: float,
+    workspace: Workspace = None,
+    slowest_tasks=None,
+    signatures=None,
+):
+    """Record the result of a trial in the ledger"""
+    snapshot_dirs = []
+    if workspace is not None:
+        snapshot_dirs.append(workspace.snapshots)
+    artifacts = None
+    if output_path is not None:
+        snapshot_dirs.append(f"{output_path}/snapshots")
+        artifacts = sorted(
+            os.path.join(output_path, name) for name in os.listdir(output_path)
+        )
+    LEDGER.record(
+        module.name,
+        transformation.name,
+        transformation.parameters(),
+        transformation.seed,
+        started,
+        time.time() - started,
+        outcome,
+        output_path,
+        finding_signature(signatures) if signatures else None,
+        snapshot_digests(snapshot_dirs),
+        artifacts,
+        slowest_tasks,
+        module.test_digest,
+        len(module.edits),
+    )
+
+
+def run_role_in_docker(
+    module: BaseModuleTest,
+    transformation: BaseTransformation,
+    workspace: Workspace,
+    pool: ContainerPool,
+    seed=None,
+):
+    """A trial on its own pair of containers, a seed replays the random choices of an earlier transform()"""
+    started = time.time()
+    # Copies module to <workspace>/host/mnt/test and perturbs it
+    apply_transformation(module, transformation, workspace, seed)
+    generate_playbook(module, workspace)
+
+    ## Do not spend a container run on a test identical to the baseline or to an earlier trial
+    if is_no_op(module, transformation):
+        print(
+            emoji.emojize("💤"),
+            f" {transformation.name} did not change the test of {module.name} in a new way, skipping",
         )
-        target = None
-    else:  # Ansible setting
-        host_mount = [
-            docker.types.Mount("/mnt", f"{os.getcwd()}/host/mnt", type="bind"),
-        ]
-        ## Launch host container
-        host = client.containers.run(
-            "testing:host", mounts=host_mount, detach=True, environment=env
+        record_trial(module, transformation, "no_op", None, started)
+        return 0, "no_op"
+
+    ## Skip the tasks the trial shares with the baseline, if it was checkpointed
+    resume_plan = None
+    if (
+        CHECKPOINTS_ENABLED
+        and module.name in MODULE_CHECKPOINTS
+        and transformation.name != "no_transformation"
+    ):
+        resume_plan = plan_resume(
+            f"output/{module.name}/baseline/test",
+            module.copied_path,
+            MODULE_CHECKPOINTS[module.name],
         )
-        # Launch target container
-        target_mount = [
-            docker.types.Mount("/mnt", f"{os.getcwd()}/target/mnt", type="bind"),
-        ]
-        ## Expose target's port 22 on port 2222 on local PC
-        target = client.containers.run(
-            "testing:target", ports={"22/tcp": 2222}, mounts=target_mount, detach=True
+        if resume_plan is not None:
+            print(
+                f"Resuming {module.name} from checkpoint {resume_plan.checkpoint.state_id}, skipping {resume_plan.skipped_tasks} tasks"
+            )
+            apply_resume_plan(
+                resume_plan,
+                module.copied_path,
+                f"output/{module.name}/baseline/snapshots",
+                workspace,
+            )
+
+    client = docker.from_env()
+
+    ## Reuse the baseline of a previous campaign if none of its inputs changed
+    baseline_key = None
+    checkpoint_tag = module.name
+    if BASELINE_CACHE is not None and transformation.name == "no_transformation":
+        baseline_key = BASELINE_CACHE.key(
+            workspace.host_mnt,
+            [
+                client.images.get(module.host_image or pool.host_image).id,
+                client.images.get(pool.target_image).id,
+            ],
+            {"REPRODUCE": os.getenv("REPRODUCE"), "type": type(module).__name__},
         )
-        ## Add the target container's IP address to the inventory of the host
-        inventory = client.containers.get(target.attrs["Id"]).attrs["NetworkSettings"][
-            "IPAddress"
-        ]
-        host.exec_run(f'bash -c "echo {inventory} >> /etc/ansible/hosts"')
-
-    ## TODO: Why do i need to rm the directory first????
-    host.exec_run(f"rm -r /{module.base_path}")
-    ## This command overwrites the existing test case with our mounted testcase, via a symlink:
-    host.exec_run(f"ln -s -f /mnt/test /{module.base_path}")
-
-    ## Now Execute tests and capture output
-    test_command = module.get_exec_command()
-
-    # breakpoint()
-    output = host.exec_run(test_command)
-    ## Dump output
-    output_filename = f"host/mnt/logs.txt"
-    with open(output_filename, "w") as output_file:
-        output_file.write(output.output.decode("utf-8"))
-
-    # Capture target container if necessary to get the script output
+        checkpoint_tag = f"{module.name}-{baseline_key[:12]}"
+        output_path = f"output/{module.name}/baseline"
+        need_checkpoints = CHECKPOINTS_ENABLED and not module.creates_container
+        checkpoints = BASELINE_CACHE.load(
+            baseline_key, output_path, client, need_checkpoints=need_checkpoints
+        )
+        if checkpoints is not None:
+            print(emoji.emojize("♻️"), f" Reusing the cached baseline of {module.name}")
+            MODULE_BASELINES[module.name] = grab_states(f"{output_path}/snapshots")
+            ## Only checkpoints whose images load() made sure still exist
+            if need_checkpoints:
+                MODULE_CHECKPOINTS[module.name] = checkpoints
+            record_trial(
+                module, transformation, "baseline_cached", output_path, started
+            )
+            return 0, "baseline_cached"
+
     if module.creates_container:
-        for container in client.containers.list():
-            if "beaker" in container.attrs["Name"]:
-                target = container
-                # Create a tar archive of the snapshots folder
-                with open("target/mnt/snapshots.tar", "wb") as f:
-                    bits, _ = target.get_archive("/mnt/snapshots")
-                    for chunk in bits:
-                        f.write(chunk)
-                # Extract the archive folder
-                with tarfile.open("target/mnt/snapshots.tar") as t:
-                    t.extractall("target/mnt")
-                break
+        # Beaker containers cannot be told apart, so only one Puppet trial runs at a time
+        with PUPPET_LOCK:
+            remove_leftover_containers(client, beaker_only=True)
+            outcome, output_path, signatures = run_tests_in_docker(
+                client, module, transformation, workspace, pool
+            )
+    else:
+        outcome, output_path, signatures = run_tests_in_docker(
+            client, module, transformation, workspace, pool, resume_plan, checkpoint_tag
+        )
+    if baseline_key is not None and outcome == "baseline":
+        BASELINE_CACHE.store(
+            baseline_key, output_path, MODULE_CHECKPOINTS.get(module.name, []), client
+        )
+    task_results = TaskResults.load(workspace.task_results)
+    record_trial(
+        module,
+        transformation,
+        outcome,
+        output_path,
+        started,
+        workspace,
+        task_results.slowest_tasks() if task_results is not None else None,
+        signatures,
+    )
+    return count_new_signatures(module, signatures), outcome
+
+
+def count_new_signatures(module: BaseModuleTest, signatures: set):
+    """The novelty of a trial: how many of its state difference signatures were never seen for the module"""
+    with FINGERPRINTS_LOCK:
+        new_signatures = signatures - MODULE_SIGNATURES[module.name]
+        MODULE_SIGNATURES[module.name] |= new_signatures
+    return len(new_signatures)
+
 
-    ## Now process output, if the run was a baseline run, save the output, else, compare to baseline results
+def difference_signatures(
+    crashed, state_differences, timed_out=False, failing_tasks=()
+):
+    """
+    Where the trial differed from the baseline: a timeout, a crash at its failing tasks,
+    or a path of a state key at a given state
+    """
+    signatures = {(state_id, key, path) for state_id, key, path in state_differences}
+    if timed_out:
+        signatures.add(("timeout",))
+    elif crashed:
+        signatures.add(("crash",) + tuple(failing_tasks))
+    return signatures
+
+
+def finding_signature(signatures: set):
+    """The signature of a finding, equal for trials that differ from the baseline in the same way"""
+    if len(signatures) == 0:
+        return None
+    description = "\n".join(
+        sorted(json.dumps(list(signature), default=str) for signature in signatures)
+    )
+    return hashlib.sha256(description.encode()).hexdigest()[:12]
+
+
+def register_finding(module: BaseModuleTest, signatures: set):
+    """Count a finding, returns its signature and how many times it was found so far, this one included"""
+    signature = finding_signature(signatures)
+    with FINGERPRINTS_LOCK:
+        FINDING_COUNTS[(module.name, signature)] += 1
+        return signature, FINDING_COUNTS[(module.name, signature)]
+
+
+def is_no_op(module: BaseModuleTest, transformation: BaseTransformation):
+    """
+    Whether the transformed test was already seen for this module
+    The baseline's own test is always run, and registered first
+    """
+    digest = FINGERPRINTER.tree_digest(module.copied_path)
+    module.test_digest = digest
+    with FINGERPRINTS_LOCK:
+        seen = digest in MODULE_FINGERPRINTS[module.name]
+        MODULE_FINGERPRINTS[module.name].add(digest)
+    return seen and transformation.name != "no_transformation"
+
+
+def forget_fingerprint(module: BaseModuleTest):
+    """Let the transformed test of a trial that could not be evaluated run again"""
+    with FINGERPRINTS_LOCK:
+        MODULE_FINGERPRINTS[module.name].discard(module.test_digest)
+
+
+def start_collector_agent(target, module: BaseModuleTest, workspace: Workspace):
+    """
+    Start collect_state.py as an agent on the target, and wait until it listens for requests
+    If it does not, the snapshot tasks run the script themselves
+    """
+    target.exec_run(
+        f"python3 /mnt/test/collect_state.py --agent {snapshot_args(module)}",
+        detach=True,
+    )
+    requests = os.path.join(workspace.target_mnt, "collector", "requests")
+    deadline = time.time() + 10
+    while not os.path.exists(requests) and time.time() < deadline:
+        time.sleep(0.05)
+
+
+class ChunkStream(io.RawIOBase):
+    """Read-only file object over an iterator of byte chunks, e.g. a Docker archive stream"""
+
+    def __init__(self, chunks) -> None:
+        self.chunks = iter(chunks)
+        self.buffer = memoryview(b"")
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, b) -> int:
+        while len(self.buffer) == 0:
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                return 0
+            self.buffer = memoryview(chunk)
+        size = min(len(b), len(self.buffer))
+        b[:size] = self.buffer[:size]
+        self.buffer = self.buffer[size:]
+        return size
+
+
+def generate_inventory(target_ips: list, workspace: Workspace, host_vars=None):
+    """
+    Write the inventory of the trial to the workspace, so the warm host container is left untouched
+    host_vars holds the variables of each target, if any
+    """
+    with open("host/ansible/hosts") as template:
+        inventory = template.read()
+    hosts = []
+    for position, target_ip in enumerate(target_ips):
+        variables = host_vars[position] if host_vars is not None else {}
+        hosts.append(" ".join([target_ip] + [f"{k}={v}" for k, v in variables.items()]))
+    with open(os.path.join(workspace.host_mnt, "inventory"), "w") as inventory_file:
+        inventory_file.write(inventory.rstrip("\n") + "\n" + "\n".join(hosts) + "\n")
+
+
+def generate_fan_out_playbook(workspace: Workspace):
+    """
+    Every host of a fan-out run includes the role of its own trial
+    With the free strategy, a host does not wait for the slowest trial at every task
+    """
+    playbook = """
+---
+- hosts: test_target
+  strategy: free
+  tasks:
+    - include_role:
+        name: "{{ thefuzz_role }}"
+"""
+    with open(workspace.playbook, "w") as playbook_file:
+        playbook_file.write(playbook)
+
+
+def split_task_results(workspace: Workspace, hosts: dict):
+    """Route the task results of a fan-out run to the workspace of the trial of each host"""
+    if not os.path.exists(workspace.task_results):
+        return
+    lines = defaultdict(list)
+    with open(workspace.task_results) as f:
+        for line in f:
+            try:
+                lines[json.loads(line).get("host")].append(line)
+            except json.JSONDecodeError:
+                continue
+    for host, sub_workspace in hosts.items():
+        with open(sub_workspace.task_results, "w") as f:
+            f.writelines(lines[host])
+
+
+def has_recap(workspace: Workspace) -> bool:
+    """Whether the task results of a host of a fan-out run end with its recap"""
+    task_results = TaskResults.load(workspace.task_results)
+    return task_results is not None and task_results.finished
+
+
+def can_share_run(module: BaseModuleTest, other: BaseModuleTest):
+    """Ansible trials on the same host image can run side by side, on targets of their own"""
+    return (
+        not module.creates_container
+        and not other.creates_container
+        and module.host_image == other.host_image
+    )
+
+
+def run_fan_out(trials: list, workspace: Workspace, pool: ContainerPool):
+    """
+    Run several transformed Ansible trials with a single ansible-playbook run
+    Each trial gets its own copy of its role, its own target and its own snapshots,
+    in a workspace of its own under <workspace>/host/mnt/fan_<i>, and the role a host runs is one of its variables
+    Trials that change the environment setup, which is shared by the run, run on their own afterwards,
+    and so do all of the trials if the run did not end with a recap for each host: a failure in the shared log
+    could be any host's. Either way with the seed they were transformed with, so the same test runs.
+    Returns the novelty and the outcome of every trial
+    """
+    started = time.time()
+    results = [(0, "no_op")] * len(trials)
+    with open("env_setup.sh") as f:
+        default_setup = f.read()
+
+    batch = []
+    solo = []
+    for position, (module, transformation) in enumerate(trials):
+        sub_workspace = Workspace(
+            os.path.join(workspace.host_mnt, f"fan_{position}"), workspace.slot
+        )
+        sub_workspace.reset()
+        apply_transformation(module, transformation, sub_workspace)
+        with open(f"{module.copied_path}/env_setup.sh") as f:
+            if f.read() != default_setup:
+                solo.append(position)
+                continue
+        if is_no_op(module, transformation):
+            print(
+                emoji.emojize("💤"),
+                f" {transformation.name} did not change the test of {module.name} in a new way, skipping",
+            )
+            record_trial(module, transformation, "no_op", None, started)
+            continue
+        batch.append((position, module, transformation, sub_workspace))
+
+    if len(batch) > 0:
+        client = docker.from_env()
+        pair = pool.acquire(workspace, batch[0][1].host_image)
+        targets = []
+        host_dirty = True
+        try:
+            hosts = {}
+            host_vars = []
+            for position, module, _, sub_workspace in batch:
+                target = pool.start_extra_target(sub_workspace)
+                targets.append(target)
+                target.reload()
+                hosts[target.attrs["NetworkSettings"]["IPAddress"]] = sub_workspace
+                role = f"/{module.base_path}__fan{position}"
+                test = f"/mnt/fan_{position}/host/mnt/test"
+                ## The role of the trial, and its module's own path for env_setup.sh
+                pair.host.exec_run(f"rm -rf /{module.base_path} {role}")
+                pair.host.exec_run(f"ln -s {test} /{module.base_path}")
+                pair.host.exec_run(f"ln -s {test} {role}")
+                host_vars.append({"thefuzz_role": role})
+                if SNAPSHOT_AGENT:
+                    start_collector_agent(target, module, sub_workspace)
+            generate_inventory(list(hosts), workspace, host_vars)
+            generate_fan_out_playbook(workspace)
+
+            exec_env = {
+                "ANSIBLE_INVENTORY": "/mnt/inventory",
+                "ANSIBLE_FORKS": str(len(batch)),
+                "ANSIBLE_CALLBACK_PLUGINS": "/etc/ansible/callback_plugins",
+                "ANSIBLE_CALLBACKS_ENABLED": "thefuzz_results",
+                "THEFUZZ_RESULTS": "/mnt/task_results.jsonl",
+            }
+            run = stream_exec(
+                client,
+                pair.host,
+                batch[0][1].get_exec_command(),
+                workspace.logs,
+                environment=exec_env,
+                timeout=TRIAL_TIMEOUT,
+                idle_timeout=IDLE_TIMEOUT,
+            )
+            host_dirty = run.aborted is not None
+            split_task_results(workspace, hosts)
+
+            if run.aborted is not None or not all(
+                has_recap(sub_workspace) for _, _, _, sub_workspace in batch
+            ):
+                print(
+                    emoji.emojize("🔀"),
+                    f" The shared run of {len(batch)} trials cannot be told apart, running them on their own",
+                )
+                for position, module, _, _ in batch:
+                    forget_fingerprint(module)
+                    solo.append(position)
+                batch = []
+
+            for position, module, transformation, sub_workspace in batch:
+                shutil.copy(workspace.logs, sub_workspace.logs)
+                outcome, output_path, signatures = evaluate_trial(
+                    module, transformation, sub_workspace, run.timed_out
+                )
+                task_results = TaskResults.load(sub_workspace.task_results)
+                record_trial(
+                    module,
+                    transformation,
+                    outcome,
+                    output_path,
+                    started,
+                    sub_workspace,
+                    task_results.slowest_tasks() if task_results is not None else None,
+                    signatures,
+                )
+                results[position] = count_new_signatures(module, signatures), outcome
+        finally:
+            for target in targets:
+                remove_container(target)
+            pool.release(workspace, pair, target_used=False, host_dirty=host_dirty)
+
+    for position in sorted(solo):
+        module, transformation = trials[position]
+        workspace.reset()
+        results[position] = run_role_in_docker(
+            module, transformation, workspace, pool, transformation.seed
+        )
+    return results
+
+
+def run_tests_in_docker(
+    client,
+    module: BaseModuleTest,
+    transformation: BaseTransformation,
+    workspace: Workspace,
+    pool: ContainerPool,
+    resume_plan=None,
+    checkpoint_tag=None,
+    evaluate=None,
+):
+    """Run the transformed test in a pair of containers, and evaluate the trial with evaluate (evaluate_trial by default)"""
+    ## Take a warm pair of containers, they mount the workspace's directories to both provide and collect data for the experiments
+    pair = pool.acquire(workspace, module.host_image, module.creates_container)
+    host = pair.host
+    target = pair.target
+    beaker = None
+    exec_env = {}
+    if resume_plan is not None:
+        ## The pool's fresh target stays unused, the trial runs on a copy of the checkpoint
+        target = start_checkpoint_target(
+            client, resume_plan.checkpoint, workspace, pool.labels
+        )
+    if not module.creates_container:  # Ansible setting
+        ## Add the target container's IP address to the inventory of the trial
+        target.reload()
+        generate_inventory([target.attrs["NetworkSettings"]["IPAddress"]], workspace)
+        exec_env["ANSIBLE_INVENTORY"] = "/mnt/inventory"
+        ## Task results and timings, as JSON lines (host/ansible/callback_plugins)
+        exec_env["ANSIBLE_CALLBACK_PLUGINS"] = "/etc/ansible/callback_plugins"
+        exec_env["ANSIBLE_CALLBACKS_ENABLED"] = "thefuzz_results"
+        exec_env["THEFUZZ_RESULTS"] = "/mnt/task_results.jsonl"
+        if SNAPSHOT_AGENT:
+            start_collector_agent(target, module, workspace)
+
+    host_dirty = True
+    try:
+        ## TODO: Why do i need to rm the directory first????
+        host.exec_run(f"rm -r /{module.base_path}")
+        ## This command overwrites the existing test case with our mounted testcase, via a symlink:
+        host.exec_run(f"ln -s -f /mnt/test /{module.base_path}")
+
+        if module.creates_container and BEAKER_IMAGES:
+            image = provision_beaker_image(
+                client, host, module, workspace, exec_env, timeout=TRIAL_TIMEOUT
+            )
+            if image is not None:
+                write_nodeset(os.path.join(workspace.host_mnt, "nodeset.yml"), image)
+                module.beaker_nodeset = "/mnt/nodeset.yml"
+
+        ## Now Execute tests, the output is written to the logs as it arrives
+        test_command = module.get_exec_command()
+
+        def execute():
+            return stream_exec(
+                client,
+                host,
+                test_command,
+                workspace.logs,
+                environment=exec_env,
+                timeout=TRIAL_TIMEOUT,
+                idle_timeout=IDLE_TIMEOUT,
+            )
+
+        if (
+            CHECKPOINTS_ENABLED
+            and not module.creates_container
+            and transformation.name == "no_transformation"
+        ):
+            run, MODULE_CHECKPOINTS[module.name] = run_with_checkpoints(
+                execute, target, workspace, tag=checkpoint_tag
+            )
+        else:
+            run = execute()
+        if run.aborted is not None:
+            print(
+                emoji.emojize("⏱️"),
+                f" Stopped the tests of {module.name} with transformation {transformation.name} early: {run.aborted}",
+            )
+
+        # Capture target container if necessary to get the script output
+        if module.creates_container:
+            for container in client.containers.list():
+                if "beaker" in container.attrs["Name"]:
+                    beaker = container
+                    # Extract the snapshots folder as its archive is streamed out of the container
+                    bits, _ = beaker.get_archive("/mnt/snapshots")
+                    with tarfile.open(fileobj=ChunkStream(bits), mode="r|") as t:
+                        t.extractall(workspace.target_mnt)
+                    break
+        ## An abandoned test command is still running in the host
+        host_dirty = run.aborted is not None
+
+        return (evaluate or evaluate_trial)(
+            module, transformation, workspace, run.timed_out
+        )
+    finally:
+        ## Now hand the containers back, the target is replaced in the background
+        pool.release(
+            workspace,
+            pair,
+            target_used=not module.creates_container and resume_plan is None,
+            host_dirty=host_dirty,
+        )
+        if beaker is not None:
+            remove_container(beaker)
+        if resume_plan is not None:
+            remove_container(target)
+
+
+def evaluate_trial(
+    module: BaseModuleTest,
+    transformation: BaseTransformation,
+    workspace: Workspace,
+    timed_out=False,
+):
+    """
+    Process the output, if the run was a baseline run, save the output, else, compare to baseline results
+    Returns the outcome of the trial, the output path it was saved to, if any, and the signatures of its differences
+    """
     baseline_run = transformation.name == "no_transformation"
 
     if baseline_run:
         ## Save output to a special folder
-        global MODULE_BASELINE
-        MODULE_BASELINE = grab_states()
         output_path = f"output/{module.name}/baseline"
         if os.path.exists(output_path):
             shutil.rmtree(output_path)
 
-        # pathlib.Path(output_path).mkdir(parents=True, exist_ok=True)
-
-        shutil.copytree("host/mnt", f"{output_path}")
-        if os.path.exists("target/mnt/snapshots"):
-            shutil.copytree("target/mnt/snapshots", f"{output_path}/snapshots")
-        else:
+        if not os.path.exists(workspace.snapshots):
             raise Exception("No snapshots were created")
-    else:
-        ## Check output, if either a crash occurs or if the output state differs to the baseline, we save the output, else we do not
-        try:
-            crashed = detect_crashes()
-
-            ## Calculate output path if we detected an error
-            t_id = 0
-            if os.path.exists(f"output/{module.name}"):
-                all_equal_ts = [
-                    int(t.lstrip(transformation.name))
-                    for t in os.listdir(f"output/{module.name}")
-                    if t.startswith(transformation.name)
-                ]
-                if len(all_equal_ts) > 0:
-                    t_id = max(all_equal_ts) + 1
-            output_path = f"output/{module.name}/{transformation.name}{t_id:09d}"
-            no_error = True
-
-            if crashed:
-                print(
-                    emoji.emojize("🧐"),
-                    "detected an abnormal exit of the test suite, saving logs to output: ",
-                    output_path,
-                )
-                shutil.copytree("host/mnt", f"{output_path}")
-                no_error = False
+        ARTIFACTS.store(
+            output_path, [(workspace.host_mnt, ""), (workspace.snapshots, "snapshots")]
+        )
+        # Read from the output, the workspace is emptied for the next trial
+        MODULE_BASELINES[module.name] = grab_states(f"{output_path}/snapshots")
+        if timed_out:
+            # Still the reference of the trials, but not worth caching
+            print(emoji.emojize("⚠️"), f" The baseline of {module.name} timed out")
+            return "baseline_timeout", output_path, set()
+        return "baseline", output_path, set()
+
+    ## Check output, if either a crash occurs or if the output state differs to the baseline, we save the output, else we do not
+    try:
+        crashed, failing_tasks, differing_paths, signatures = trial_differences(
+            module, transformation, workspace, timed_out
+        )
+        if not crashed and differing_paths == []:
+            print(emoji.emojize("😃"), " Nothing Detected")
+            return "nothing", None, set()
 
-            state_differences = compare_to_baseline()
-            if state_differences != []:
-                ## Copy mnt to output
-                # First, get latest id
-                print(
-                    emoji.emojize("🧐"),
-                    "detected an difference between states of the baseline test suite and out modifications, saving intermediate states to output: ",
-                    output_path,
-                )
-                if os.path.exists("target/mnt/snapshots"):
-                    shutil.copytree("target/mnt/snapshots", f"{output_path}/snapshots")
-                else:
-                    raise Exception("No snapshots were created")
-                no_error = False
-            if no_error:
-                print(emoji.emojize("😃"), " Nothing Detected")
-
-        except Exception as e:
-            print("Evaluation Failed")
-            print(e)
-
-    ## Now Nuke the containers
-    host.stop()
-    host.remove()
-    if target is not None:
-        target.stop()
-        target.remove()
-
-
-def detect_crashes():
-    with open(f"host/mnt/logs.txt") as output:
-        if "failed=0" not in output.read() and " 0 failures" not in output.read():
+        ## A finding seen before is only counted, it already has an output directory
+        signature, count = register_finding(module, signatures)
+        if count > 1:
             print(
-                f"ERROR found in: {MODULE_UNDER_TEST}, with transformation: {TRANSFORMATION_UNDER_TEST}"
+                emoji.emojize("🔁"),
+                f" {module.name} with transformation {transformation.name}: finding {signature} again, {count} times so far",
             )
-            return True
-    return False
+            return "duplicate", None, signatures
 
+        if crashed and not timed_out:
+            print(
+                f"ERROR found in: {module.name}, with transformation: {transformation.name}"
+            )
+            for failing_task in failing_tasks:
+                print(f"  {failing_task}")
+        for state_id, key, path in differing_paths:
+            print(
+                f"STATE DIFFERENCE found in: {module.name} at state: {state_id}, with transformation: {transformation.name}: {key}:/{path}"
+            )
+        output_path = reserve_output_path(module, transformation)
+        LEDGER.record_signature(
+            module.name, signature, sorted(signatures, key=str), output_path
+        )
+        ## Only the contents not stored yet take space, the output directory links to them
+        artifacts = []
+        if timed_out:
+            print(
+                emoji.emojize("🧐"),
+                "the test suite timed out, saving logs to output: ",
+                output_path,
+            )
+            artifacts.append((workspace.host_mnt, ""))
+        elif crashed:
+            print(
+                emoji.emojize("🧐"),
+                "detected an abnormal exit of the test suite, saving logs to output: ",
+                output_path,
+            )
+            artifacts.append((workspace.host_mnt, ""))
 
-def compare_to_baseline():
+        if differing_paths != []:
+            ## Copy snapshots to output
+            print(
+                emoji.emojize("🧐"),
+                "detected an difference between states of the baseline test suite and out modifications, saving intermediate states to output: ",
+                output_path,
+            )
+            if os.path.exists(workspace.snapshots):
+                artifacts.append((workspace.snapshots, "snapshots"))
+            else:
+                raise Exception("No snapshots were created")
+        ARTIFACTS.store(output_path, artifacts)
+        if timed_out:
+            return "timeout", output_path, signatures
+        if crashed and differing_paths != []:
+            return "crash_and_difference", output_path, signatures
+        return ("crash" if crashed else "difference"), output_path, signatures
+
+    except Exception as e:
+        print("Evaluation Failed")
+        print(e)
+        return "evaluation_failed", None, set()
+
+
+def trial_differences(
+    module: BaseModuleTest,
+    transformation: BaseTransformation,
+    workspace: Workspace,
+    timed_out=False,
+):
     """
-    Compares the states in target/mnt after running tests to the baseline states
+    How a transformed trial differs from the baseline: whether it crashed, its failing tasks,
+    its differing state paths, and the signatures of all of these
     """
+    crashed, failing_tasks = detect_crashes(workspace)
+    crashed = crashed or timed_out
+    differing_paths = [
+        difference_path
+        for difference in compare_to_baseline(module, transformation, workspace)
+        for difference_path in state_difference_paths(
+            *difference, transformation.generated
+        )
+    ]
+    signatures = set()
+    if crashed or differing_paths != []:
+        signatures = difference_signatures(
+            crashed, differing_paths, timed_out, failing_tasks
+        )
+    return crashed, failing_tasks, differing_paths, signatures
 
-    current_states = grab_states()
-    num_states = len(current_states)
 
-    difference = []
-    if num_states != len(MODULE_BASELINE):
-        num_states = min(num_states, len(MODULE_BASELINE))
-        print(
-            f"Different number of states for: {MODULE_UNDER_TEST}, with transformation: {TRANSFORMATION_UNDER_TEST}"
+def detect_crashes(workspace: Workspace):
+    """
+    Whether the run crashed, and the tasks (or rspec examples) that failed it
+    The failing tasks leave the hosts out, so trials failing the same way on different targets agree
+    """
+    ## Ansible runs report their task results, the logs are only parsed for Puppet runs
+    task_results = TaskResults.load(workspace.task_results)
+    if task_results is not None:
+        return task_results.crashed, sorted(
+            {
+                f"{result['status']}: task {result['position']} '{result['task']}' ({result['module']})"
+                for result in task_results.failed_tasks()
+            }
         )
-        print(f"Only comparing the first {num_states} states")
+    watcher = LogWatcher()
+    with open(workspace.logs, errors="replace") as output:
+        for line in output:
+            watcher.parse_line(line)
+    return watcher.crashed, [
+        f"failed: example '{example}'" for example in watcher.failed_examples
+    ]
 
-    for state_id in range(num_states):
-        if MODULE_BASELINE[state_id] != current_states[state_id]:
-            no_errors = False
-            print(
-                f"STATE DIFFERENCE found in: {MODULE_UNDER_TEST} at state: {state_id}, with transformation: {TRANSFORMATION_UNDER_TEST}"
+
+def state_fingerprint(state: State):
+    """Equal fingerprints for equal states, from the digests of the state when it has them"""
+    if len(state.digests) > 0:
+        return json.dumps(state.digests, sort_keys=True)
+    return json.dumps(state.state, sort_keys=True, default=str)
+
+
+def unique_anchors(a: list, b: list) -> list:
+    """
+    (i, j) of the items that occur exactly once in a and once in b, a[i] == b[j],
+    keeping the longest run of them that is in the same order in both (patience sorting)
+    """
+    counts = defaultdict(lambda: [0, 0, None, None])
+    for i, item in enumerate(a):
+        counts[item][0] += 1
+        counts[item][2] = i
+    for j, item in enumerate(b):
+        counts[item][1] += 1
+        counts[item][3] = j
+    pairs = sorted(
+        (i, j) for in_a, in_b, i, j in counts.values() if in_a == 1 and in_b == 1
+    )
+
+    # Longest increasing subsequence of the positions in b
+    tails = []
+    tail_indexes = []
+    previous = []
+    for index, (_, j) in enumerate(pairs):
+        position = bisect.bisect_left(tails, j)
+        if position == len(tails):
+            tails.append(j)
+            tail_indexes.append(index)
+        else:
+            tails[position] = j
+            tail_indexes[position] = index
+        previous.append(tail_indexes[position - 1] if position > 0 else None)
+    anchors = []
+    index = tail_indexes[-1] if len(tail_indexes) > 0 else None
+    while index is not None:
+        anchors.append(pairs[index])
+        index = previous[index]
+    return anchors[::-1]
+
+
+def alignment_opcodes(a: list, b: list, a_start=0, b_start=0) -> list:
+    """
+    Opcodes turning a into b, like difflib's SequenceMatcher.get_opcodes()
+    The common prefix and suffix, then the items unique to both sequences, are matched first,
+    only the stretches left between them go through SequenceMatcher, which is quadratic
+    """
+    prefix = 0
+    while prefix < min(len(a), len(b)) and a[prefix] == b[prefix]:
+        prefix += 1
+    suffix = 0
+    while suffix < min(len(a), len(b)) - prefix and a[-1 - suffix] == b[-1 - suffix]:
+        suffix += 1
+
+    opcodes = []
+    if prefix > 0:
+        opcodes.append(("equal", a_start, a_start + prefix, b_start, b_start + prefix))
+    middle_a = a[prefix : len(a) - suffix]
+    middle_b = b[prefix : len(b) - suffix]
+    a_middle = a_start + prefix
+    b_middle = b_start + prefix
+    anchors = unique_anchors(middle_a, middle_b)
+    if len(anchors) > 0:
+        i = j = 0
+        for anchor_i, anchor_j in anchors + [(len(middle_a), len(middle_b))]:
+            opcodes += alignment_opcodes(
+                middle_a[i:anchor_i], middle_b[j:anchor_j], a_middle + i, b_middle + j
             )
-            print(f"Baseline state: {MODULE_BASELINE[state_id].state}")
-            print(f"Transformed state: {current_states[state_id].state}")
+            if anchor_i < len(middle_a):
+                opcodes.append(
+                    (
+                        "equal",
+                        a_middle + anchor_i,
+                        a_middle + anchor_i + 1,
+                        b_middle + anchor_j,
+                        b_middle + anchor_j + 1,
+                    )
+                )
+            i, j = anchor_i + 1, anchor_j + 1
+    elif len(middle_a) > 0 or len(middle_b) > 0:
+        matcher = difflib.SequenceMatcher(None, middle_a, middle_b, autojunk=False)
+        for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+            opcodes.append(
+                (tag, a_middle + i1, a_middle + i2, b_middle + j1, b_middle + j2)
+            )
+    if suffix > 0:
+        opcodes.append(
+            (
+                "equal",
+                a_start + len(a) - suffix,
+                a_start + len(a),
+                b_start + len(b) - suffix,
+                b_start + len(b),
+            )
+        )
+    return opcodes
+
+
+def align_states(baseline_states, current_states):
+    """
+    Align two sequences of states on their fingerprints, with alignment_opcodes()
+    Returns (kind, baseline_id, current_id) for every state that is not matched:
+    a "mismatch" pairs two states, an "inserted" state of the trial goes before baseline_id,
+    and a "deleted" state of the baseline has no current_id
+    An inserted state equal to the one before it (e.g. a duplicated idempotent task) is not reported
+    """
+    baseline = [state_fingerprint(state) for state in baseline_states]
+    current = [state_fingerprint(state) for state in current_states]
+
+    unmatched = []
+    for tag, i1, i2, j1, j2 in alignment_opcodes(baseline, current):
+        if tag == "equal":
+            continue
+        paired = min(i2 - i1, j2 - j1) if tag == "replace" else 0
+        for offset in range(paired):
+            unmatched.append(("mismatch", i1 + offset, j1 + offset))
+        for i in range(i1 + paired, i2):
+            unmatched.append(("deleted", i, None))
+        for j in range(j1 + paired, j2):
+            if j > 0 and current[j] == current[j - 1]:
+                continue
+            unmatched.append(("inserted", i1 + paired, j))
+    return unmatched
+
+
+def normalize_path(path, generated=()):
+    """
+    A path into a state as a string, with the random values a transformation generated masked
+    Values of a character or two are only masked as whole components, they are too likely to occur by chance
+    """
+    components = []
+    for component in map(str, path):
+        for value in generated:
+            if component == value or (len(value) > 2 and value in component):
+                component = component.replace(value, "<generated>")
+        components.append(component)
+    return "/".join(components)
+
+
+def state_difference_paths(
+    state_id, baseline_state, current_state, paths, generated=()
+):
+    """
+    (state_id, key, path) of every path a difference touches, normalized with normalize_path
+    Inserted and deleted states count as a whole
+    """
+    if baseline_state is None:
+        return [(state_id, "inserted", "")]
+    if current_state is None:
+        return [(state_id, "deleted", "")]
+    return sorted(
+        {(state_id, key, normalize_path(path, generated)) for key, path in paths}
+    )
+
+
+def compare_to_baseline(
+    module: BaseModuleTest, transformation: BaseTransformation, workspace: Workspace
+):
+    """
+    Compares the states in the workspace's target/mnt after running tests to the baseline states
+    The sequences are aligned first, so extra or missing snapshots only report themselves
+    Returns [baseline state id, baseline state, transformed state, differing paths] for every difference,
+    where the baseline state is None for inserted states and the transformed state None for deleted ones
+    Nothing is printed here, the differences of a finding are only reported the first time it is found
+    """
 
+    baseline_states = MODULE_BASELINES[module.name]
+    current_states = grab_states(workspace.snapshots)
+
+    difference = []
+    for kind, state_id, current_id in align_states(baseline_states, current_states):
+        if kind == "inserted":
+            difference.append([state_id, None, current_states[current_id].state, []])
+        elif kind == "deleted":
+            difference.append([state_id, baseline_states[state_id].state, None, []])
+        else:
             difference.append(
                 [
                     state_id,
-                    MODULE_BASELINE[state_id].state,
-                    current_states[state_id].state,
+                    baseline_states[state_id].state,
+                    current_states[current_id].state,
+                    baseline_states[state_id].diff(current_states[current_id]),
                 ]
             )
     return difference
 
 
-def grab_states():
-    if not os.path.exists("target/mnt/snapshots"):
+def grab_states(snapshot_dir):
+    """The states of a run, indexed by their ID, decoded lazily from its snapshot log"""
+    snapshot_log = os.path.join(snapshot_dir, SNAPSHOT_LOG_NAME)
+    if not os.path.exists(snapshot_log):
         raise Exception("No snapshots were created")
-    all_states = {}
-    ps = os.listdir(f"target/mnt/snapshots")
-    for p in ps:
-        state: State = pickle.load(
-            open(
-                f"target/mnt/snapshots/{p}",
-                "rb",
-            )
-        )
-        # Extract its ID
-        state_id = int(p.rstrip(".pkl").lstrip("state_"))
-        all_states[state_id] = state
-    return all_states
+    return SnapshotLog(snapshot_log)
 
 
 def main():
-    create_empty_folder("output")
-
-    config_path = create_config()
+    args = parse_args()
+    global CHECKPOINTS_ENABLED, BASELINE_CACHE, SNAPSHOT_ARGS, SNAPSHOT_AGENT, BEAKER_IMAGES
+    global FAN_OUT, LEDGER, ARTIFACTS
+    global TRIAL_TIMEOUT, IDLE_TIMEOUT
+    CHECKPOINTS_ENABLED = args.checkpoints
+    SNAPSHOT_AGENT = not args.no_snapshot_agent
+    BEAKER_IMAGES = not args.no_beaker_image
+    FAN_OUT = max(1, args.fan_out)
+    TRIAL_TIMEOUT = args.timeout
+    IDLE_TIMEOUT = args.idle_timeout
+    SNAPSHOT_ARGS = f"--hash-algorithm {args.hash_algorithm}"
+    if args.file_metadata:
+        SNAPSHOT_ARGS += " --file-metadata"
+    if not args.no_cache:
+        BASELINE_CACHE = BaselineCache(args.cache_dir)
+    ## output/ is kept between campaigns: the ledger and the stored artifacts span all of them
+    os.makedirs("output", exist_ok=True)
+    LEDGER = Ledger("output/ledger.sqlite")
+    ARTIFACTS = ArtifactStore("output/objects")
+    ## Findings of earlier campaigns are known already, they are only counted
+    FINDING_COUNTS.update(LEDGER.finding_counts())
+
+    config_path = create_config(args)
     config = read_config(config_path)
 
-    global MODULE_UNDER_TEST
-    global TRANSFORMATION_UNDER_TEST
-
     module_trans = transformations_per_module(config)
-    # First, get baseline runs for each module
+
+    ## First make sure the containers of previous campaigns are gone:
+    remove_leftover_containers(docker.from_env())
     for module in module_trans.keys():
-        MODULE_UNDER_TEST = module.name
-        transformation = NoTransformation()
-        TRANSFORMATION_UNDER_TEST = transformation.name
-        print(f"Testing role: {module.name} with no transformation")
-        run_role_in_docker(module, transformation)
-    # Then, run random transformations for random modules
-    while len(module_trans) > 0:
-        module = random.choice(list(module_trans.keys()))
-        MODULE_UNDER_TEST = module.name
-        transformation = random.choice(module_trans[module])
-        TRANSFORMATION_UNDER_TEST = transformation.name
-        print(
-            f"Testing role: {module.name} with transformation: {transformation.description}"
-        )
-        run_role_in_docker(module, transformation)
-        if not transformation.repeat:
-            module_trans[module].remove(transformation)
-            if len(module_trans[module]) == 0:
-                del module_trans[module]
+        prepare_module(module)
+        if module.reproduce is not None:
+            prepare_reproduction(
+                docker.from_env(), module, module.reproduce, args.reproduce_dir
+            )
+
+    ## Each worker runs its trials in a workspace of its own
+    create_empty_folder(args.workspaces)
+    workspaces = create_workspaces(args.workspaces, args.jobs)
+    free_workspaces = queue.Queue()
+    for workspace in workspaces:
+        free_workspaces.put(workspace)
+    ## Containers are started ahead of time, and recycled in the background between trials
+    pool = ContainerPool(
+        docker.from_env(),
+        workspaces,
+        labels={CONTAINER_LABEL: str(os.getpid())},
+        env={"REPRODUCE": os.getenv("REPRODUCE")},
+        max_host_uses=args.max_host_uses,
+        docker_socket=all(module.creates_container for module in module_trans),
+    )
+
+    def run_trial(module, transformation):
+        workspace = free_workspaces.get()
+        try:
+            workspace.reset()
+            # Transformations mutate the module (copied_path) and draw their own seed, so each trial gets its own
+            return run_role_in_docker(
+                copy.copy(module), copy.copy(transformation), workspace, pool
+            )
+        finally:
+            free_workspaces.put(workspace)
+
+    def run_batch(trials):
+        if len(trials) == 1:
+            return [run_trial(*trials[0])]
+        workspace = free_workspaces.get()
+        try:
+            workspace.reset()
+            return run_fan_out(
+                [
+                    (copy.copy(module), copy.copy(transformation))
+                    for module, transformation in trials
+                ],
+                workspace,
+                pool,
+            )
+        finally:
+            free_workspaces.put(workspace)
+
+    scheduler = SCHEDULERS[args.scheduler](
+        module_trans,
+        max_trials=args.max_trials,
+        time_budget=args.time_budget,
+        max_duplicates=args.max_duplicates,
+    )
+    try:
+        run_campaign(module_trans, scheduler, run_trial, run_batch, args.jobs, FAN_OUT)
+    finally:
+        pool.close()
+        remove_unused_checkpoints(docker.from_env())
+
+
+def remove_unused_checkpoints(client):
+    """Once the campaign is over, remove the checkpoint images no cached baseline refers to"""
+    cached = BASELINE_CACHE.images() if BASELINE_CACHE is not None else set()
+    remove_images(
+        client,
+        [
+            checkpoint.image
+            for checkpoints in MODULE_CHECKPOINTS.values()
+            for checkpoint in checkpoints
+            if checkpoint.image not in cached
+        ],
+    )
+
+
+def take_batch(scheduler, pending: list, fan_out: int):
+    """
+    The arms of the next run: up to fan_out arms that can share a run
+    An arm that cannot join the batch is kept in pending for the next one
+    """
+    batch = []
+    while len(batch) < fan_out:
+        arm = pending.pop(0) if len(pending) > 0 else scheduler.next()
+        if arm is None:
+            break
+        if len(batch) > 0 and not can_share_run(batch[0].module, arm.module):
+            pending.append(arm)
+            break
+        batch.append(arm)
+    return batch
+
+
+def run_campaign(module_trans, scheduler, run_trial, run_batch, jobs, fan_out=1):
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        # First, get baseline runs for each module
+        baselines = []
+        for module in module_trans.keys():
+            print(f"Testing role: {module.name} with no transformation")
+            baselines.append(executor.submit(run_trial, module, NoTransformation()))
+        for baseline in baselines:
+            baseline.result()
+
+        # Then, let the scheduler pick the transformed trials, keeping every worker busy
+        running = {}
+        pending = []
+        while True:
+            while len(running) < jobs:
+                batch = take_batch(scheduler, pending, fan_out)
+                if len(batch) == 0:
+                    break
+                for arm in batch:
+                    print(
+                        f"Testing role: {arm.module.name} with transformation: {arm.transformation.description}"
+                    )
+                trials = [(arm.module, arm.transformation) for arm in batch]
+                running[executor.submit(run_batch, trials)] = batch
+            if len(running) == 0:
+                break
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for trial in done:
+                batch = running.pop(trial)
+                for arm, (novelty, outcome) in zip(batch, trial.result()):
+                    scheduler.update(arm, novelty, outcome)
 
 
 if __name__ == "__main__":
@@ -1,8 +1,9 @@
+from collect_state import agent_trigger
 from module import BaseModuleTest
 import random
 
 
-def get_random_unicode(length):
+def get_random_unicode(length, rng=random):
     # Update this to include code point ranges to be sampled
     include_ranges = [
         (0x0021, 0x0021),
@@ -25,7 +26,7 @@ def get_random_unicode(length):
         for current_range in include_ranges
         for code_point in range(current_range[0], current_range[1] + 1)
     ]
-    random_unicode = "".join(random.choice(alphabet) for i in range(length))
+    random_unicode = "".join(rng.choice(alphabet) for i in range(length))
     return random_unicode
 
 
@@ -45,6 +46,34 @@ class BaseTransformation:
         self.name = name
         self.description = description
         self.repeat = repeat
+        self.seed = None
+        self.rng = random
+        ## The random values the last transform() wrote into the test
+        self.generated = []
+        ## Values replacing some of the generated ones, by position, when a trial is replayed
+        self.overrides = {}
+
+    def reseed(self, seed=None):
+        """Draw the random choices of the next transform() from a generator of its own, so the trial can be replayed from its seed"""
+        self.seed = seed if seed is not None else random.getrandbits(32)
+        self.rng = random.Random(self.seed)
+        self.generated = []
+
+    def parameters(self) -> dict:
+        """The options the transformation was configured with"""
+        return {
+            key: value
+            for key, value in vars(self).items()
+            if key
+            not in ("name", "description", "seed", "rng", "generated", "overrides")
+        }
+
+    def generate_unicode(self, length: int) -> str:
+        """A random unicode value to write into the test, drawn even when an override replaces it"""
+        value = sanitize_unicode(get_random_unicode(length, self.rng))
+        value = self.overrides.get(len(self.generated), value)
+        self.generated.append(value)
+        return value
 
     def transform(self, test: BaseModuleTest):
         """Transform a module test suite."""
@@ -82,9 +111,9 @@ class ChangeLanguage(BaseTransformation):
     def transform(self, test: BaseModuleTest):
         """Transform a module test suite."""
         if self.languages is None:
-            selected_lang = random.choice(list(self.potential_languages.values()))
+            selected_lang = self.rng.choice(list(self.potential_languages.values()))
         else:
-            selected_lang = self.potential_languages[random.choice(self.languages)]
+            selected_lang = self.potential_languages[self.rng.choice(self.languages)]
         test.set_env_var("LC_ALL", selected_lang)
 
 
@@ -120,8 +149,7 @@ class ChangeFilenames(BaseTransformation):
             filename = value.split("/")[-1]
             if "{{" in filename or "}}" in filename or " " in filename:
                 continue
-            new_filename = get_random_unicode(random.randint(1, 20))
-            new_filename = sanitize_unicode(new_filename)
+            new_filename = self.generate_unicode(self.rng.randint(1, 20))
             test.replace_in_filenames_with(filename, new_filename)
             test.replace_in_code_with(filename, new_filename)
 
@@ -150,8 +178,7 @@ class ChangeField(BaseTransformation):
     def transform(self, test: BaseModuleTest):
         values = test.get_values_of_options(self.keys)
         for value in values:
-            new_value = get_random_unicode(random.randint(1, 60))
-            new_value = sanitize_unicode(new_value)
+            new_value = self.generate_unicode(self.rng.randint(1, 60))
             test.replace_in_code_with(value, new_value)
 
 
@@ -178,9 +205,20 @@ class DryRunMode(BaseTransformation):
 
 
 class CaptureSnapshot(BaseTransformation):
-    def __init__(self):
+    def __init__(self, args="", agent=False):
         super().__init__("capture_snapshots", f"Collect state before each unit test")
+        # Command line arguments of collect_state.py
+        self.args = args
+        # Request the snapshots from the collector agent of the target (Ansible only)
+        self.agent = agent
 
     def transform(self, test: BaseModuleTest):
         test.add_file("collect_state.py")
-        test.exec_script_after_task(script="collect_state.py", task_name=test.name)
+        if self.agent and not test.creates_container:
+            test.exec_command_after_task(
+                command=agent_trigger(self.args), task_name=test.name
+            )
+            return
+        test.exec_script_after_task(
+            script="collect_state.py", task_name=test.name, args=self.args
+        )
@@ -0,0 +1,114 @@
+import fcntl
+import os
+import shutil
+
+## Files smaller than this are copied, cloning them would not save anything
+CLONE_THRESHOLD = 64 * 1024
+## ioctl cloning a file into another, on btrfs, XFS and other copy-on-write filesystems
+FICLONE = 0x40049409
+
+
+class Workspace:
+    """
+    Scratch space for a single trial.
+    Every trial gets its own host/mnt and target/mnt directories, which are mounted
+    into the trial's own containers, so several trials can run side by side
+    """
+
+    def __init__(self, root: str, slot: int) -> None:
+        self.root = root
+        self.slot = slot
+        self.host_mnt = os.path.join(root, "host", "mnt")
+        self.target_mnt = os.path.join(root, "target", "mnt")
+
+    @property
+    def host_test(self) -> str:
+        return os.path.join(self.host_mnt, "test")
+
+    @property
+    def target_test(self) -> str:
+        return os.path.join(self.target_mnt, "test")
+
+    @property
+    def playbook(self) -> str:
+        return os.path.join(self.host_mnt, "playbook.yml")
+
+    @property
+    def logs(self) -> str:
+        return os.path.join(self.host_mnt, "logs.txt")
+
+    @property
+    def task_results(self) -> str:
+        """Written by the thefuzz_results callback plugin during Ansible runs"""
+        return os.path.join(self.host_mnt, "task_results.jsonl")
+
+    @property
+    def snapshots(self) -> str:
+        return os.path.join(self.target_mnt, "snapshots")
+
+    @property
+    def container_prefix(self) -> str:
+        """Container names are unique per workspace so trials never collide"""
+        return f"thefuzz-{os.getpid()}-{self.slot}"
+
+    @property
+    def ssh_port(self) -> int:
+        """Local port on which the target's port 22 is exposed, for debugging"""
+        return 2222 + self.slot
+
+    def reset(self, host_template: str = "host/mnt") -> None:
+        """
+        Start from empty host/mnt and target/mnt directories
+        The directories themselves are kept, as they are bind mounted into warm containers
+        The static files of host_template (e.g. the reproduction scripts) are copied over
+        """
+        for path in (self.host_mnt, self.target_mnt):
+            os.makedirs(path, exist_ok=True)
+            for entry in os.scandir(path):
+                if entry.is_dir(follow_symlinks=False):
+                    shutil.rmtree(entry.path)
+                else:
+                    os.remove(entry.path)
+        if not os.path.isdir(host_template):
+            return
+        for filename in os.listdir(host_template):
+            filepath = os.path.join(host_template, filename)
+            if os.path.isfile(filepath):
+                shutil.copy(filepath, self.host_mnt)
+
+
+def create_workspaces(root: str, count: int) -> list:
+    """Create one workspace per worker under root"""
+    workspaces = [Workspace(os.path.join(root, f"worker_{i}"), i) for i in range(count)]
+    for workspace in workspaces:
+        os.makedirs(workspace.host_mnt, exist_ok=True)
+        os.makedirs(workspace.target_mnt, exist_ok=True)
+    return workspaces
+
+
+def clone_file(src: str, dst: str) -> None:
+    """
+    A copy of src sharing its blocks until either is written (a reflink), on filesystems that support it
+    Falls back to a plain copy. Unlike a hardlink, writing the clone never changes src.
+    """
+    try:
+        with open(src, "rb") as source, open(dst, "wb") as destination:
+            fcntl.ioctl(destination.fileno(), FICLONE, source.fileno())
+        shutil.copystat(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+
+def clone_tree(source: str, destination: str) -> None:
+    """
+    Copy of a directory tree whose large files are cloned with clone_file() instead of copied.
+    The containers mount the copy read-write, so nothing in it may be shared with the source tree.
+    """
+
+    def copy_function(src, dst):
+        if os.path.getsize(src) < CLONE_THRESHOLD:
+            return shutil.copy2(src, dst)
+        clone_file(src, dst)
+        return dst
+
+    shutil.copytree(source, destination, copy_function=copy_function, symlinks=True)